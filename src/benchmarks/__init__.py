@@ -0,0 +1,6 @@
+"""
+Throughput and latency benchmarks for both MCTS engines.
+
+    $ cd src
+    $ python -m benchmarks.run --output results.json --baseline benchmarks/baseline.json
+"""
@@ -0,0 +1,55 @@
+import sys
+import importlib
+
+from pathlib import Path
+
+SRC_DIR = Path(__file__).resolve().parent.parent
+
+# Engine directory, budget keyword and search method of each engine
+ENGINES = {
+    'mcts_rollout': ('budgets', 'search'),
+    'mcts_no_rollout': ('n_iters', 'do_planning'),
+}
+
+_LOADED = {}
+
+def load_engine(name):
+    """
+    The tic_tac_toe module of an engine directory.
+
+    Both engines import their own flat modules (mcts, tree, utils, ...) by the
+    same names, so each one is imported with its directory first on sys.path
+    and its modules are taken out of sys.modules again afterwards. The loaded
+    modules keep their references to each other.
+    """
+    module = _LOADED.get(name)
+    if module is not None:
+        return module
+    if name not in ENGINES:
+        raise ValueError(f"unknown engine {name!r}, expected one of {sorted(ENGINES)}")
+
+    engine_dir = str(SRC_DIR / name)
+    before = set(sys.modules)
+    sys.path.insert(0, engine_dir)
+    try:
+        module = importlib.import_module('tic_tac_toe')
+    finally:
+        sys.path.remove(engine_dir)
+        for key in set(sys.modules) - before:
+            if getattr(sys.modules[key], '__file__', None) and \
+                    sys.modules[key].__file__.startswith(engine_dir):
+                del sys.modules[key]
+    _LOADED[name] = module
+    return module
+
+def make_engine(name, state, budget, seed, **kwargs):
+    # A silent engine so the benchmark measures the search and not the terminal
+    module = load_engine(name)
+    budget_arg, _ = ENGINES[name]
+    kwargs.setdefault('verbose', False)
+    kwargs[budget_arg] = budget
+    return module.MCTS(state=state, seed=seed, **kwargs)
+
+def run_search(name, mcts):
+    _, method = ENGINES[name]
+    return getattr(mcts, method)()
@@ -0,0 +1,33 @@
+# Fixed positions per board size as the moves that lead to them, X moves first.
+# Every position leaves the side to move with a real choice.
+POSITIONS = {
+    3: {
+        'empty': [],
+        'midgame': [(1, 1), (0, 0), (0, 2), (2, 0)],
+        'near_terminal': [(0, 0), (0, 1), (1, 1), (2, 2), (0, 2), (2, 0)],
+    },
+    4: {
+        'empty': [],
+        'midgame': [(1, 1), (0, 0), (2, 2), (3, 3), (1, 2), (2, 1)],
+        'near_terminal': [(0, 0), (0, 1), (0, 2), (0, 3), (1, 0), (1, 1),
+                          (1, 2), (1, 3), (2, 1), (2, 0), (2, 2), (3, 2)],
+    },
+    15: {
+        'empty': [],
+        'midgame': [(7, 7), (7, 8), (8, 8), (6, 6), (8, 7), (6, 7), (9, 9), (5, 5)],
+        'near_terminal': [(7, 7), (7, 8), (8, 8), (6, 6), (9, 9), (10, 10), (6, 8),
+                          (5, 9), (8, 6), (5, 8), (7, 9), (5, 7)],
+    },
+}
+
+# Board options other than the size, 15x15 is played five in a row with
+# moves near the stones only
+BOARDS = {
+    15: dict(k=5, radius=2),
+}
+
+def make_position(module, size, name):
+    board = module.TTTBoard(size=size, **BOARDS.get(size, {}))
+    for row, col in POSITIONS[size][name]:
+        board.push(row, col)
+    return board
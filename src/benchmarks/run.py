@@ -0,0 +1,163 @@
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+
+from .engines import ENGINES, make_engine, load_engine, run_search
+from .positions import POSITIONS, make_position
+
+# Metrics compared against the baseline, and whether higher values are better
+COMPARED = {
+    'iterations_per_second': True,
+    'nodes_per_second': True,
+    'latency_p50_ms': False,
+    'latency_p90_ms': False,
+    'bytes_per_node': False,
+    'accuracy': True,
+}
+
+def bench_case(engine, size, position, budget, repeats, seed):
+    """
+    Search the same position repeats times, each time on a fresh engine with its
+    own seed, then once more under tracemalloc for the memory per node: what
+    the search allocated on top of the freshly built engine, whose empty tree
+    is preallocated, over the nodes it created. On boards the oracle has
+    solved, accuracy is the share of searches that found a perfect move.
+    """
+    module = load_engine(engine)
+    state = make_position(module, size, position)
+    oracle = module.get_oracle(state)
+    best_actions = oracle.best_actions(state) if oracle is not None else None
+    n_perfect = 0
+
+    latencies = []
+    iterations = nodes = 0
+    search_time = 0.0
+    peak_nodes = 0
+    for i in range(repeats):
+        mcts = make_engine(engine, state, budget, seed + i)
+        start = time.perf_counter()
+        board = run_search(engine, mcts)
+        latencies.append(time.perf_counter() - start)
+        if best_actions is not None:
+            n_perfect += played_action(state, board) in best_actions
+
+        stats = mcts.stats()
+        iterations += stats['iterations']
+        nodes += stats['nodes_created']
+        search_time += stats['search_time']
+        peak_nodes = max(peak_nodes, stats['tree_nodes'])
+
+    tracemalloc.start()
+    try:
+        mcts = make_engine(engine, state, budget, seed)
+        empty_bytes, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        run_search(engine, mcts)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        'engine': engine,
+        'size': size,
+        'position': position,
+        'budget': budget,
+        'repeats': repeats,
+        'iterations_per_second': iterations / search_time,
+        'nodes_per_second': nodes / search_time,
+        'peak_tree_nodes': peak_nodes,
+        'bytes_per_node': (peak_bytes - empty_bytes) / len(mcts.tree),
+        'latency_p50_ms': float(np.percentile(latencies_ms, 50)),
+        'latency_p90_ms': float(np.percentile(latencies_ms, 90)),
+        'latency_p99_ms': float(np.percentile(latencies_ms, 99)),
+        'accuracy': None if best_actions is None else n_perfect / repeats,
+    }
+
+def played_action(state, board):
+    # The one cell taken on board that is empty on state
+    occupied = lambda b: b.bitboards[b.first_player] | b.bitboards[b.second_player]
+    cell = (occupied(board) & ~occupied(state)).bit_length() - 1
+    return divmod(cell, state.size)
+
+def case_key(result):
+    return result['engine'], result['size'], result['position']
+
+def compare(results, baseline, tolerance):
+    """
+    Relative change of every compared metric against the baseline. A metric
+    regresses when it got worse by more than tolerance.
+    """
+    baseline = {case_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        old = baseline.get(case_key(result))
+        # Only runs with the same budget per move and number of moves are comparable
+        if old is None or old['budget'] != result['budget'] or old['repeats'] != result['repeats']:
+            continue
+        for metric, higher_is_better in COMPARED.items():
+            if old.get(metric) is None or result[metric] is None:
+                continue
+            change = result[metric] / old[metric] - 1 if old[metric] else 0.0
+            worse = -change if higher_is_better else change
+            line = f"{'/'.join(map(str, case_key(result)))} {metric}: {old[metric]:.1f} -> {result[metric]:.1f} ({change:+.1%})"
+            print(("REGRESSION " if worse > tolerance else "           ") + line)
+            if worse > tolerance:
+                regressions.append(line)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark both MCTS engines on fixed positions.")
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=list(ENGINES))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[3, 4], choices=sorted(POSITIONS))
+    parser.add_argument('--positions', nargs='+', default=['empty', 'midgame', 'near_terminal'])
+    parser.add_argument('--budget', type=int, default=400, help="iterations per move")
+    parser.add_argument('--repeats', type=int, default=5, help="moves searched per case")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="compare against this JSON file")
+    parser.add_argument('--save-baseline', action='store_true', help="write the results to --baseline instead")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="relative change counted as a regression")
+    args = parser.parse_args(argv)
+
+    results = []
+    for engine in args.engines:
+        for size in args.sizes:
+            for position in args.positions:
+                result = bench_case(engine, size, position, args.budget, args.repeats, args.seed)
+                print(f"{engine:16s} {size}x{size} {position:14s} "
+                      f"{result['iterations_per_second']:9.1f} it/s "
+                      f"{result['nodes_per_second']:9.1f} nodes/s "
+                      f"{result['peak_tree_nodes']:7d} nodes "
+                      f"{result['bytes_per_node']:7.1f} B/node "
+                      f"p50 {result['latency_p50_ms']:8.1f} ms "
+                      f"p99 {result['latency_p99_ms']:8.1f} ms"
+                      + ("" if result['accuracy'] is None else f" accuracy {result['accuracy']:.0%}"))
+                results.append(result)
+
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'numpy': np.__version__,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+    elif args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,6 @@
+import time
 import random
+import logging
 import numpy as np
 import networkx as nx
 import matplotlib.pyplot as plt
@@ -6,6 +8,11 @@ import matplotlib.pyplot as plt
 from dataclasses import dataclass
 from networkx.drawing.nx_agraph import graphviz_layout
 
+from oracle import UNKNOWN, get_oracle
+from parallel import get_process_pool, split_budget, spawn_seeds
+from policies import get_policy
+from profiling import PhaseProfiler, profile_target
+from tree import SearchTree
 from utils import ShellColors as sc
 
 import signal
@@ -14,6 +21,8 @@ def handler(signum, frame):
 # Set the signal handler
 signal.signal(signal.SIGINT, handler)
 
+logger = logging.getLogger(__name__)
+
 @dataclass
 class NodeData:
     DEPTH = 'depth'
@@ -22,10 +31,21 @@ class NodeData:
     VISITS = 'visits'
     REWARD = 'reward'
     Q = 'q'
-    HISTORY = 'history'
     NODE = 'node'
     PLAYER = 'player'
 
+# Cheap counters kept by every engine, see MCTS.stats()
+COUNTERS = ('iterations', 'nodes_created', 'terminal_hits', 'simulated_moves', 'book_hits', 'search_time')
+
+# The methods timed for each search phase when profiling is on,
+# expansion happens inside selection
+PHASES = {
+    'selection': ['_select_action'],
+    'expansion': ['_expand_node'],
+    'simulation': ['_simulate'],
+    'backup': ['_backup'],
+}
+
 class MCTS(NodeData):
 
     def __init__(
@@ -34,139 +54,540 @@ class MCTS(NodeData):
         sampling_method=None,
         n_iters=1200, 
         exploration_constant=1.414,
+        policy='ucb1',
+        prior=None,
         max_depth=20,
         gamma=1,
+        transposition=False,
+        symmetry=False,
+        n_workers=1,
+        solver=False,
+        oracle=False,
+        book=None,
+        seed=None,
+        verbose=True,
+        log_interval=None,
+        profile=None,
         visible_graph=False
     ):
         self.state = state
         self._sampling_method = sampling_method
         self._n_iters = n_iters
         self.c = exploration_constant
+        # Selection policy, 'ucb1', 'ucb1_tuned', 'puct' or a policy object, see policies.py.
+        # prior(state, actions) gives the prior probabilities of a node's actions for PUCT,
+        # its untried actions are then expanded in order of prior.
+        self.policy = get_policy(policy, exploration_constant)
+        self.prior = prior
         self._max_depth = max_depth
         self.gamma = gamma
+        # With a transposition table equal positions share one node and the tree becomes a DAG
+        self.transposition = transposition
+        self._table = {}
+        # With symmetry only one child per class of symmetric positions is expanded
+        self.symmetry = symmetry
+        # More than one worker runs independent root-parallel searches in a process pool
+        self.n_workers = n_workers
+        # The solver proves terminal nodes and their ancestors won, lost or drawn,
+        # skips solved children and stops once the root is solved
+        self.solver = solver
+        # On boards small enough to be solved exactly, see oracle.py, oracle='root'
+        # (or True) plays the perfect move without planning and oracle='leaf' keeps
+        # planning but ends every descent one move below the root with the
+        # perfect-play reward
+        self.oracle = 'root' if oracle is True else oracle
+        self._oracle = get_oracle(state) if oracle else None
+        # An OpeningBook shared between engines, see book.py. A position found in it
+        # is played straight away and every planning adds its result to it.
+        self.book = book
+        self._seed = seed
+        self._random = random.Random(seed)
+        # verbose=False keeps the planning loop silent, progress is then read
+        # through stats() or logged every log_interval seconds
+        self.verbose = verbose
+        self.log_interval = log_interval
+        self._counters = dict.fromkeys(COUNTERS, 0)
+        self._next_log = None
+        self._search_start = None
+        # Per-phase timings, switched on by profile or the MCTS_PROFILE environment
+        # variable, see profile_target(). Spans add up over every planning call.
+        self.profile = profile_target(profile)
+        self.profiler = None
+        if self.profile is not None:
+            self.profiler = PhaseProfiler()
+            self.profiler.instrument(self, PHASES)
         self.visible = visible_graph
         self.tree = self._create_tree(state)
+        self._root_transforms = None
         
     def _create_tree(self, state):
-        tree = nx.DiGraph()
-        tree.add_node(0)
-        tree.update(
-            nodes=[(0, {NodeData.DEPTH: 0,
-                        NodeData.STATE: state,
-                        NodeData.ACTION: None,
-                        NodeData.VISITS: 0,
-                        NodeData.REWARD: 0,
-                        NodeData.Q: -np.inf,
-                        NodeData.NODE: 0,
-                        NodeData.PLAYER: state.first_player,
-                        NodeData.HISTORY: []})])
+        tree = SearchTree()
+        root = tree.add_node(state, depth=0, player=state.first_player)
+        self._counters['nodes_created'] += 1
+        if self.transposition:
+            self._table[self._table_key(state)] = root
         return tree
 
-    def do_planning(self):
-        for i in range(self._n_iters):
-            print(f"{sc.HEADER}=========== Search iteration : {i+1} ==========={sc.ENDC}")
-            self._search(cur_node=0, depth=0)
+    def do_planning(self, time_limit=None, early_stop=False):
+        """
+        Run n_iters iterations, or as many as fit in time_limit seconds when it
+        is given (n_iters=None plans until the deadline). With early_stop the
+        planning ends as soon as the most visited root child can no longer be
+        overtaken by another child within the remaining budget.
+        """
+        if self._n_iters is None and time_limit is None:
+            raise ValueError("do_planning needs n_iters or a time_limit")
+        start = self._search_start = time.monotonic()
+        deadline = None if time_limit is None else start + time_limit
+        self._next_log = start + self.log_interval if self.log_interval else None
+        try:
+            move = self.instant_move()
+            if move is not None:
+                return move
+
+            if self.n_workers > 1:
+                return self._plan_root_parallel(time_limit, early_stop)
+
+            self._run_iterations(self._n_iters, deadline, early_stop)
             # if self.visible:
-            #     if (i+1) % self._n_iters == 0:
-            #         self.visualize("Backpropagatge")
-            #         print("==="*20)
+            #     self.visualize("Backpropagatge")
+            #     print("==="*20)
+            return self._get_best_action(root_node=0)
+        finally:
+            self._counters['search_time'] += time.monotonic() - start
+            self._search_start = None
+            if self.log_interval:
+                self._log_stats()
+            if self.profiler is not None:
+                self._report_profile()
+
+    def instant_move(self):
+        """The book or oracle move for the current state, None when it has to be searched."""
+        if self.book is not None:
+            move = self._book_move()
+            if move is not None:
+                return move
+        if self._oracle is not None and self.oracle == 'root':
+            return self._oracle_move()
+        return None
+
+    def step(self, n_iters, deadline=None):
+        """
+        Run up to n_iters more iterations on the current tree, fewer when the
+        deadline passes or the root is solved, and return how many ran. A
+        scheduler interleaves the steps of many games, see scheduler.py, and
+        reads the result with best_move().
+        """
+        start = self._search_start = time.monotonic()
+        try:
+            return self._run_iterations(n_iters, deadline)
+        finally:
+            self._counters['search_time'] += time.monotonic() - start
+            self._search_start = None
+
+    def best_move(self):
         return self._get_best_action(root_node=0)
 
-    def _search(self, cur_node, depth):
-        state = self.tree.nodes[cur_node][NodeData.STATE]
-        # print(state)
-
-        # Not use in tic-tac-toe game
-        if depth >= self._max_depth:
-            return 0
-
-        if self._is_terminal(state, depth):
-            reward = self._get_reward(state)
-            self.tree.nodes[cur_node][NodeData.VISITS] += 1
-            self.tree.nodes[cur_node][NodeData.REWARD] = reward
-            self.tree.nodes[cur_node][NodeData.Q] = reward
-            self.tree.nodes[cur_node][NodeData.HISTORY].append(reward)
-            return reward
-
-        action, next_node = self._select_action(cur_node, state, depth)
-        # self.visualize(f"SelectAction Node: {cur_node} Depth: {depth}")
-        
-        next_state, reward = self._simulate(state, action)
-        self.tree.nodes[next_node][NodeData.STATE] = next_state
-        # print(f"Simulate Node: {cur_node} Depth: {depth}")
-        # self.visualize("Simulate")
+    def _run_iterations(self, n_iters, deadline=None, early_stop=False):
+        start = time.monotonic()
+        i = 0
+        while n_iters is None or i < n_iters:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            if self.solver and not np.isnan(self.tree.proven[0]):
+                break
+            if self.verbose:
+                print(f"{sc.HEADER}=========== Search iteration : {i+1} ==========={sc.ENDC}")
+            self._search(cur_node=0, depth=0)
+            i += 1
+            if self._next_log is not None and time.monotonic() >= self._next_log:
+                self._next_log += self.log_interval
+                self._log_stats()
+
+            if early_stop and self._is_decided(
+                    self._remaining_iterations(i, n_iters, start, deadline)):
+                break
+        return i
+
+    def stats(self):
+        """
+        Counters accumulated over every planning call of this engine, plus the
+        current tree size and the rates derived from them.
+        """
+        stats = dict(self._counters)
+        if self._search_start is not None:
+            stats['search_time'] += time.monotonic() - self._search_start
+        stats['tree_nodes'] = len(self.tree)
+        stats['iterations_per_second'] = stats['iterations'] / stats['search_time'] if stats['search_time'] else 0.0
+        stats['mean_simulation_length'] = stats['simulated_moves'] / stats['iterations'] if stats['iterations'] else 0.0
+        return stats
+
+    def _log_stats(self):
+        stats = self.stats()
+        logger.info("iterations=%d nodes=%d terminal_hits=%d mean_simulation_length=%.2f "
+                    "iterations_per_second=%.1f",
+                    stats['iterations'], stats['tree_nodes'], stats['terminal_hits'],
+                    stats['mean_simulation_length'], stats['iterations_per_second'])
+
+    def _report_profile(self):
+        if self.profile == 'summary':
+            logger.info("search phases\n%s", self.profiler.format_summary())
+        else:
+            self.profiler.write_chrome_trace(self.profile)
+
+    def _remaining_iterations(self, done, budgets, start, deadline):
+        # Iterations left before the budget or the deadline, whichever comes first
+        remaining = np.inf if budgets is None else budgets - done
+        if deadline is not None:
+            now = time.monotonic()
+            rate = done / max(now - start, 1e-9)
+            remaining = min(remaining, rate * (deadline - now))
+        return remaining
+
+    def _is_decided(self, remaining):
+        # The most visited root child can no longer be overtaken. Untried root
+        # actions are competitors with no visits yet, and only a root with a single
+        # action at all is decided before its other children are expanded.
+        tree = self.tree
+        if tree.n_reserved[0] < 2:
+            return tree.n_reserved[0] == 1
+        visits = tree.visits[tree.children(0)]
+        if tree.n_untried(0):
+            visits = np.append(visits, 0)
+        second, first = np.partition(visits, -2)[-2:]
+        return first - second > remaining
+
+    def _plan_root_parallel(self, time_limit=None, early_stop=False):
+        n_workers = self.n_workers if self._n_iters is None else min(self.n_workers, self._n_iters)
+        kwargs = dict(exploration_constant=self.c,
+                      policy=self.policy,
+                      prior=self.prior,
+                      max_depth=self._max_depth,
+                      gamma=self.gamma,
+                      transposition=self.transposition,
+                      symmetry=self.symmetry,
+                      solver=self.solver,
+                      oracle=self.oracle,
+                      verbose=False,
+                      profile=False)
+
+        pool = get_process_pool(n_workers)
+        futures = [pool.submit(_root_planning_worker, self.state, n_iters, seed, kwargs,
+                               time_limit, early_stop)
+                   for n_iters, seed in zip(split_budget(self._n_iters, n_workers),
+                                            spawn_seeds(self._seed, n_workers))]
+
+        # Only the root children's statistics come back from the workers,
+        # along with their counters, visits add up and Q keeps the best value any
+        # worker has seen for the side to move. The planning time is measured here.
+        sign = _side_sign(self.state)
+        best = max if sign > 0 else min
+        visits, qs = {}, {}
+        for future in futures:
+            root_stats, counters = future.result()
+            for action, n, q in root_stats:
+                visits[action] = visits.get(action, 0) + n
+                qs[action] = best(qs[action], q) if action in qs else q
+            for name in COUNTERS:
+                if name != 'search_time':
+                    self._counters[name] += counters[name]
+
+        actions = list(visits)
+        if self.verbose:
+            print(f"Q : {[qs[action] for action in actions]}")
+            print(f"Visits: {[visits[action] for action in actions]}")
+        best_action = actions[np.argmax([sign * qs[action] for action in actions])]
+        if self.book is not None:
+            self.book.put(self.state, best_action, [(action, visits[action], qs[action]) for action in actions])
+        return self.state.move(*best_action)
+
+    def _root_stats(self, root_node=0):
+        children = self.tree.children(root_node)
+        return list(zip(self.tree.child_actions(root_node),
+                        self.tree.visits[children].tolist(),
+                        self.tree.q[children].tolist()))
 
-        Q_sum = reward + self.gamma * self._search(next_node, depth+1)
-        self._update_value(cur_node, Q_sum)
+    def _search(self, cur_node, depth):
+        # Descend until a terminal node or the depth limit, recording the path
+        path = []
+        Q_sum = 0
+        self._counters['iterations'] += 1
+        while True:
+            state = self.tree.states[cur_node]
+            # print(state)
+
+            # Not use in tic-tac-toe game
+            if depth >= self._max_depth:
+                break
+
+            if self._is_terminal(state, depth):
+                self._counters['terminal_hits'] += 1
+                Q_sum = self._get_reward(state)
+                self.tree.visits[cur_node] += 1
+                self.tree.reward[cur_node] = Q_sum
+                self.tree.reward_sq[cur_node] += Q_sum ** 2
+                self.tree.q[cur_node] = Q_sum
+                if self.solver:
+                    self.tree.proven[cur_node] = Q_sum
+                break
+
+            action, next_node = self._select_action(cur_node, state, depth)
+            # self.visualize(f"SelectAction Node: {cur_node} Depth: {depth}")
+
+            next_state, reward = self._simulate(state, action)
+            # A transposition node may already hold its state from another parent
+            if self.tree.states[next_node] is None:
+                self.tree.states[next_node] = next_state
+            # print(f"Simulate Node: {cur_node} Depth: {depth}")
+            # self.visualize("Simulate")
+
+            path.append((cur_node, reward))
+            cur_node = next_node
+            depth += 1
+
+        self._counters['simulated_moves'] += len(path)
+        Q_sum = self._backup(path, Q_sum)
 
         # print(f"Backpropagation Node: {cur_node} Depth: {depth}")
         # self.visualize("Backpropagation")
 
         return Q_sum
 
-    @staticmethod
-    def _is_terminal(state, depth):
+    def _backup(self, path, Q_sum):
+        # Back up along the recorded path
+        proving = self.solver
+        for node, reward in reversed(path):
+            Q_sum = reward + self.gamma * Q_sum
+            self._update_value(node, Q_sum)
+            # Only a node below that was just solved can solve its parent
+            if proving:
+                proving = self._prove(node)
+        return Q_sum
+
+    def _prove(self, node):
+        # Proven values are rewards like _get_reward(), O maximizes them and X
+        # minimizes them. A node is solved when the player to move has a child
+        # that wins, or once every action has a proven child. Returns whether
+        # node is solved.
+        tree = self.tree
+        if not np.isnan(tree.proven[node]):
+            return True
+        n_children = tree.n_children[node]
+        if not n_children:
+            return False
+        state = tree.states[node]
+        values = tree.proven[tree.children(node)]
+        best = max if state.cur_player == state.second_player else min
+        if (values == best(-1, 1)).any():
+            tree.proven[node] = best(-1, 1)
+        elif n_children == tree.n_reserved[node] and not np.isnan(values).any():
+            tree.proven[node] = best(values)
+        else:
+            return False
+        return True
+
+    def _is_terminal(self, state, depth):
         if state.check_winner() or state.is_finished():
             return True
+        # The oracle knows the outcome of every reachable position below the root
+        if self._oracle is not None and self.oracle == 'leaf' and depth > 0:
+            return self._oracle.value(state) is not None
         return False
     
     def _get_reward(self, state):
-        print(f"{sc.OKBLUE}************* Winner is {state.winner}!!! *************{sc.ENDC}")
-        if state.winner == state.first_player:
+        winner = state.winner
+        if self._oracle is not None and self.oracle == 'leaf':
+            oracle_winner = self._oracle.winner(state)
+            if oracle_winner != UNKNOWN:
+                winner = oracle_winner
+        if self.verbose:
+            print(f"{sc.OKBLUE}************* Winner is {winner}!!! *************{sc.ENDC}")
+        if winner == state.first_player:
             return -1
-        if state.winner == state.second_player:
+        if winner == state.second_player:
             return 1
         return 0
 
+    def _book_move(self):
+        # The move the book holds for the current state, None on a miss
+        entry = self.book.get(self.state)
+        if entry is None:
+            return None
+        action, _ = entry
+        self._counters['book_hits'] += 1
+        if self.verbose:
+            print(f"{sc.OKGREEN}Book move {action}{sc.ENDC}")
+        return self.state.move(*action)
+
+    def _oracle_move(self):
+        # A random one of the perfect moves, None when the oracle does not know the position
+        actions = self._oracle.best_actions(self.state)
+        if not actions:
+            return None
+        action = self._random.choice(actions)
+        if self.verbose:
+            print(f"{sc.OKGREEN}Oracle move {action} out of {actions}{sc.ENDC}")
+        return self.state.move(*action)
+
     def _select_action(self, cur_node, state, depth):
-        children = [child for child in self.tree.neighbors(cur_node)]
-        if not children:
-            print(f"Cur node {cur_node} is a leaf node, So expand")
+        # A node gets one new child per visit until it has tried every action,
+        # only then UCT chooses between its children
+        tree = self.tree
+        n_children = tree.n_children[cur_node]
+        if not n_children or n_children < tree.n_reserved[cur_node]:
+            if self.verbose:
+                print(f"Cur node {cur_node} has untried actions, So expand")
             self._expand_node(cur_node, state, depth)
-            next_node = random.choice([child for child in self.tree.neighbors(cur_node)])
+            next_idx = n_children
         else:
-            print(f"Cur node has children {children}")
-            next_node = self._find_best_node_with_uct(children)
-        action = self.tree.nodes[next_node][NodeData.ACTION]
-        print(f"Get best action node is {next_node}, and Action is {action}")
+            children = tree.children(cur_node)
+            if self.verbose:
+                print(f"Cur node has children {children.tolist()}")
+            next_idx = self._find_best_child(cur_node, children)
+        next_node = tree.children(cur_node)[next_idx]
+        action = tree.child_actions(cur_node)[next_idx]
+        if self.verbose:
+            print(f"Get best action node is {next_node}, and Action is {action}")
         return action, next_node
 
     def _expand_node(self, cur_node, state, depth):
-        possible_actions = state.get_all_possible_actions()
-        for possible_action in possible_actions:
-            next_node = self.tree.number_of_nodes()
-            self.tree.add_node(next_node)        
-            self.tree.update(nodes=[(next_node, { NodeData.DEPTH: depth+1,
-                                                  NodeData.STATE: None,
-                                                  NodeData.ACTION: possible_action,
-                                                  NodeData.VISITS: 0,
-                                                  NodeData.REWARD: 0,
-                                                  NodeData.Q: -np.inf,
-                                                  NodeData.NODE: next_node,
-                                                  NodeData.PLAYER: state.cur_player,
-                                                  NodeData.HISTORY: []})])
-            self.tree.add_edge(cur_node, next_node)
-
-    def _find_best_node_with_uct(self, children):
-        assert len(children) != 0
-
-        ucts = []
-        for child in children:
-            w = self.tree.nodes[child][NodeData.Q]
-            n = self.tree.nodes[child][NodeData.VISITS]
-            total_n = self.tree.nodes[0][NodeData.VISITS]
+        # Adds the child of the next untried action. The actions are shuffled
+        # once into the node's edge block and taken from there one at a time.
+        tree = self.tree
+        if tree.first_child[cur_node] < 0:
+            possible_actions = self._unique_actions(state, state.get_all_possible_actions())
+            self._random.shuffle(possible_actions)
+            possible_actions, priors = self._order_by_prior(state, possible_actions)
+            tree.reserve_children(cur_node, len(possible_actions), possible_actions, priors)
+
+        possible_action = tree.untried_action(cur_node)
+        if self.transposition:
+            key = self._table_key(state, possible_action)
+            node = self._table.get(key)
+            if node is not None:
+                tree.link(cur_node, node, possible_action)
+                return
+            self._table[key] = tree.add_child(cur_node, None, possible_action,
+                                              player=state.cur_player)
+        else:
+            tree.add_child(cur_node, None, possible_action, player=state.cur_player)
+        self._counters['nodes_created'] += 1
+
+    def _order_by_prior(self, state, actions):
+        # Most likely actions first, the sort is stable so ties keep their shuffled order
+        if self.prior is None or not actions:
+            return actions, None
+        priors = np.asarray(self.prior(state, actions), dtype=np.float32)
+        order = np.argsort(-priors, kind='stable')
+        return [actions[i] for i in order], priors[order]
+
+    def advance(self, state):
+        """
+        Re-root the search at state, one move after the current root. The
+        matching child keeps its subtree and statistics, the rest of the tree
+        is dropped. Without a matching child the search starts over. The tree
+        is kept as it is when state is the current root.
+        """
+        root_state = self.tree.states[0]
+        key = self._table_key(state)
+        new_root = 0 if self._table_key(root_state) == key else None
+        if new_root is None:
+            for child, action in zip(self.tree.children(0), self.tree.child_actions(0)):
+                if self._table_key(root_state, action) == key:
+                    new_root = int(child)
+                    break
 
-            if n == 0:
-                uct = float('inf')
-            else:
-                exploitation = w
-                exploration = np.sqrt(np.log(total_n) / n)
-                uct = exploitation + self.c * exploration
-            ucts.append(uct)
+        self.state = state
+        self._root_transforms = None
+        if new_root is None:
+            self._table = {}
+            self.tree = self._create_tree(state)
+            return
+
+        if new_root:
+            self.tree, mapping = self.tree.subtree(new_root)
+            if self.transposition:
+                self._table = {key: int(mapping[node]) for key, node in self._table.items()
+                               if mapping[node] >= 0}
+        if self.tree.states[0] is None:
+            self.tree.states[0] = state
+        # With symmetry the kept node may hold a symmetric image of the real board,
+        # remember how to map its moves back, see _real_action()
+        if self.tree.states[0].hash != state.hash:
+            self._root_transforms = (self.tree.states[0].canonical()[1], state.canonical()[1])
+
+    def save_tree(self, path):
+        """Write the search tree to path, see SearchTree.save()."""
+        root_state = self.tree.states[0]
+        meta = {'size': root_state.size, 'k': root_state.k, 'radius': root_state.radius}
+        self.tree.save(path, lambda state: state.to_bytes(), meta)
+
+    def load_tree(self, path):
+        """
+        Continue searching from a tree written by save_tree(). The tree must be
+        rooted at the current state, or at a symmetric image of it with symmetry
+        on. The file is memory mapped, see SearchTree.load().
+        """
+        board_cls = type(self.state)
+        tree = SearchTree.load(path, lambda data, meta: board_cls.from_bytes(data, **meta))
+        root_state = tree.states[0]
+        if self._table_key(root_state) != self._table_key(self.state):
+            raise ValueError(f"the tree in {path} is not rooted at the current state")
+
+        self.tree = tree
+        self._root_transforms = None
+        if root_state.hash != self.state.hash:
+            self._root_transforms = (root_state.canonical()[1], self.state.canonical()[1])
+        if self.transposition:
+            self._rebuild_table()
+
+    def _rebuild_table(self):
+        # Every node is the child of an edge, except the root
+        tree = self.tree
+        self._table = {self._table_key(tree.states[0]): 0}
+        for node in np.flatnonzero(tree.n_children[:tree.n_nodes]).tolist():
+            state = tree.states[node]
+            for child, action in zip(tree.children(node).tolist(), tree.child_actions(node)):
+                self._table[self._table_key(state, action)] = child
+
+    def _real_action(self, action):
+        if self._root_transforms is None:
+            return action
+        root_transform, real_transform = self._root_transforms
+        action = self.tree.states[0].transform_action(action, root_transform)
+        return self.state.transform_action(action, real_transform, inverse=True)
+
+    def _table_key(self, state, action=None):
+        # With symmetry on, all symmetric images of a position share one table entry
+        if self.symmetry:
+            return (state.canonical_after(*action) if action else state.canonical())[0]
+        return state.hash_after(*action) if action else state.hash
+
+    def _unique_actions(self, state, actions):
+        # Keep one action per class of symmetric child positions
+        if not self.symmetry:
+            return actions
+        seen = set()
+        unique_actions = []
+        for action in actions:
+            key, _ = state.canonical_after(*action)
+            if key not in seen:
+                seen.add(key)
+                unique_actions.append(action)
+        return unique_actions
+
+    def _find_best_child(self, cur_node, children):
+        assert len(children) != 0
 
-        best_node_idx = np.argmax(ucts)
-        next_node = children[best_node_idx]
-        return next_node
+        # The same side to move view as _move_values()
+        values = _side_sign(self.tree.states[cur_node]) * self.tree.q[children]
+        scores = self.policy.scores(self.tree, cur_node, children, values)
+        if self.solver:
+            # Solved children need no more search, unless nothing else is left
+            unsolved = np.isnan(self.tree.proven[children])
+            if unsolved.any():
+                scores = np.where(unsolved, scores, -np.inf)
+        return np.argmax(scores)
 
     @staticmethod
     def _simulate(state, action):
@@ -175,35 +596,74 @@ class MCTS(NodeData):
         return next_state, reward
 
     def _update_value(self, cur_node, Q_sum):
-        self.tree.nodes[cur_node][NodeData.VISITS] += 1
-        self.tree.nodes[cur_node][NodeData.HISTORY].append(Q_sum)
-        if Q_sum > self.tree.nodes[cur_node][NodeData.Q]:
-            self.tree.nodes[cur_node][NodeData.Q] = Q_sum
+        # Q is the best child value for the player to move, the two player form
+        # of keeping the best return seen. Until every action has a visited
+        # child the node counts as a win for that player. Moves earn no reward
+        # of their own, see _simulate(), so child values are only discounted.
+        tree = self.tree
+        tree.visits[cur_node] += 1
+        tree.reward_sq[cur_node] += Q_sum ** 2
+        children = tree.children(cur_node)
+        visits = tree.visits[children]
+        sign = _side_sign(tree.states[cur_node])
+        if tree.n_untried(cur_node) or visits.min() == 0:
+            if not visits.any():
+                # Only children cut off by the depth limit so far
+                tree.q[cur_node] = max(tree.q[cur_node], Q_sum)
+                return
+            best = 1
+        else:
+            values = tree.q[children]
+            best = values.max() if sign > 0 else -values.min()
+        tree.q[cur_node] = self.gamma * sign * best
 
     def _get_best_action(self, root_node=0):
-        children = [child for child in self.tree.neighbors(root_node)]
-        best_idx = np.argmax([self.tree.nodes[child][NodeData.Q] for child in children])
+        children = self.tree.children(root_node)
+        if not len(children) and self._oracle is not None:
+            # A root the oracle proved as a leaf, the solver stops before
+            # expanding it, so its move comes from the oracle too
+            return self._oracle_move()
+        best_idx = np.argmax(self._move_values(children))
         
-        print(f"Reward: {[self.tree.nodes[child][NodeData.REWARD] for child in children]}")
-        print(f"Q : {[self.tree.nodes[child][NodeData.Q] for child in children]}")
-        print(f"Visits: {[self.tree.nodes[child][NodeData.VISITS] for child in children]}")
+        if self.verbose:
+            print(f"Reward: {self.tree.reward[children].tolist()}")
+            print(f"Q : {self.tree.q[children].tolist()}")
+            print(f"Visits: {self.tree.visits[children].tolist()}")
         
-        return self.tree.nodes[children[best_idx]][NodeData.STATE]
+        # Edge actions are moves on the root's own board, even when the child node
+        # holds a symmetric image or a transposition of the resulting position
+        best_action = self._real_action(self.tree.child_actions(root_node)[best_idx])
+        if self.book is not None:
+            self.book.put(self.state, best_action, [(self._real_action(action), n, q)
+                                                    for action, n, q in self._root_stats(root_node)])
+        return self.state.move(*best_action)
+
+    def _move_values(self, children):
+        # Values from the root's side to move, see _side_sign(). Proven values
+        # override the backed up ones, a proven win for the player to move beats
+        # any unproven child.
+        sign = _side_sign(self.tree.states[0])
+        values = np.where(self.tree.visits[children] > 0, sign * self.tree.q[children], -np.inf)
+        if self.solver:
+            proven = sign * self.tree.proven[children]
+            values = np.where(np.isnan(proven), values, proven)
+            values[proven == 1] = np.inf
+        return values
 
     def visualize(self, title):
-        # visited_nodes = [n for n in self.tree.nodes if self.tree.nodes[n][NodeData.VISITS] > 0]
-        # visited_tree = self.tree.subgraph(visited_nodes)
-        labels = { n: 'D:{:d}\nV:{:d}\nR:{:d}\nQ:{:.2f}\nN:{:d}\nP:{:s}'.format(
-                self.tree.nodes[n][NodeData.DEPTH],
-                self.tree.nodes[n][NodeData.VISITS],
-                self.tree.nodes[n][NodeData.REWARD],
-                self.tree.nodes[n][NodeData.Q],
-                self.tree.nodes[n][NodeData.NODE],
-                self.tree.nodes[n][NodeData.PLAYER],) for n in self.tree.nodes}
+        # The networkx view is only built on demand, the search itself never touches it.
+        graph = self.tree.to_networkx()
+        labels = { n: 'D:{:d}\nV:{:d}\nR:{:g}\nQ:{:.2f}\nN:{:d}\nP:{:s}'.format(
+                graph.nodes[n][NodeData.DEPTH],
+                graph.nodes[n][NodeData.VISITS],
+                graph.nodes[n][NodeData.REWARD],
+                graph.nodes[n][NodeData.Q],
+                graph.nodes[n][NodeData.NODE],
+                graph.nodes[n][NodeData.PLAYER],) for n in graph.nodes}
 
         plt.figure(title, figsize=(12, 8),)
-        pos = graphviz_layout(self.tree, prog='dot')
-        nx.draw(self.tree, pos, labels=labels, node_shape="s", node_color="none",
+        pos = graphviz_layout(graph, prog='dot')
+        nx.draw(graph, pos, labels=labels, node_shape="s", node_color="none",
                 bbox=dict(facecolor="skyblue", edgecolor='black', boxstyle='round,pad=0.1'))
         plt.show()
 
@@ -229,4 +689,13 @@ class MCTS(NodeData):
 
     @budgets.setter
     def budgets(self, budgets):
-        self._budgets = budgets
\ No newline at end of file
+        self._budgets = budgets
+
+def _side_sign(state):
+    # Rewards favour O, 1 when O is to move in state and -1 when X is
+    return 1 if state.cur_player == state.second_player else -1
+
+def _root_planning_worker(state, n_iters, seed, kwargs, time_limit=None, early_stop=False):
+    mcts = MCTS(state, n_iters=n_iters, seed=seed, **kwargs)
+    mcts.do_planning(time_limit, early_stop)
+    return mcts._root_stats(), mcts._counters
@@ -0,0 +1,139 @@
+import os
+import sys
+import numpy as np
+
+# Table entry of a position that cannot be reached from the empty board
+UNKNOWN = -128
+# Boards up to this many cells are solved, 3**9 entries for 3x3
+MAX_CELLS = 9
+
+_ORACLES = {}
+
+def board_index(board):
+    """
+    Perfect hash of a position, the board read as a base 3 number with digit 0
+    for an empty cell, 1 for the first player and 2 for the second one.
+    """
+    first_bits = board.bitboards[board.first_player]
+    second_bits = board.bitboards[board.second_player]
+    index, power = 0, 1
+    for cell in range(board.size * board.size):
+        if first_bits >> cell & 1:
+            index += power
+        elif second_bits >> cell & 1:
+            index += 2 * power
+        power *= 3
+    return index
+
+def build_table(board):
+    """
+    Perfect-play value of every position reachable from the empty board of
+    board's kind: 1 when the first player wins, -1 when the second player wins
+    and 0 for a draw.
+    """
+    n_cells = board.size * board.size
+    table = np.full(3 ** n_cells, UNKNOWN, dtype=np.int8)
+    powers = [3 ** cell for cell in range(n_cells)]
+    board = type(board)(size=board.size, k=board.k)
+
+    def solve(index):
+        if table[index] != UNKNOWN:
+            return table[index]
+        if board.winner is not None:
+            value = 1 if board.winner == board.first_player else -1
+        elif not board.empty_cells:
+            value = 0
+        else:
+            first_to_move = board.cur_player == board.first_player
+            digit = 1 if first_to_move else 2
+            values = []
+            for cell in list(board.empty_cells):
+                board.push(*divmod(cell, board.size))
+                values.append(solve(index + digit * powers[cell]))
+                board.pop()
+            value = max(values) if first_to_move else min(values)
+        table[index] = value
+        return value
+
+    solve(0)
+    return table
+
+
+class Oracle:
+    """Perfect-play values and moves read from a table built by build_table()."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def value(self, board):
+        # Seen from the first player, None for a position the table does not know
+        value = int(self.table[board_index(board)])
+        return None if value == UNKNOWN else value
+
+    def winner(self, board):
+        # The player that wins with perfect play from here, None for a draw and
+        # UNKNOWN for a position the table does not know
+        value = self.value(board)
+        if value is None:
+            return UNKNOWN
+        if value:
+            return board.first_player if value > 0 else board.second_player
+        return None
+
+    def best_actions(self, board):
+        # Every move that keeps the value of the position for the player to move
+        index = board_index(board)
+        first_to_move = board.cur_player == board.first_player
+        digit = 1 if first_to_move else 2
+        actions, values = [], []
+        for cell in sorted(board.empty_cells):
+            actions.append(divmod(cell, board.size))
+            values.append(int(self.table[index + digit * 3 ** cell]))
+        if not actions or UNKNOWN in values:
+            return []
+        best = max(values) if first_to_move else min(values)
+        return [action for action, value in zip(actions, values) if value == best]
+
+def table_path(size, k):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), f'oracle_{size}x{size}_k{k}.npy')
+
+def get_oracle(board, path=None):
+    """
+    Oracle for board's size and k, None when the board is too big to solve.
+    The table is built and saved to path on first use and memory mapped from
+    there afterwards. When path cannot be written, e.g. on a read-only
+    install, the table is kept in memory for this process only.
+    """
+    if board.size * board.size > MAX_CELLS:
+        return None
+    key = (board.size, board.k)
+    oracle = _ORACLES.get(key)
+    if oracle is None:
+        path = path or table_path(*key)
+        if os.path.exists(path):
+            table = np.load(path, mmap_mode='r')
+        else:
+            table = build_table(board)
+            # Saved under a temporary name first, so a process loading the
+            # table never sees a partly written file
+            tmp_path = path + '.tmp'
+            try:
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, table)
+                os.replace(tmp_path, path)
+            except OSError:
+                pass
+        oracle = Oracle(table)
+        _ORACLES[key] = oracle
+    return oracle
+
+if __name__ == "__main__":
+    from tic_tac_toe import TTTBoard
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else size
+    board = TTTBoard(size=size, k=k)
+    table = build_table(board)
+    np.save(table_path(size, k), table)
+    print(f"{size}x{size} k={k}: {np.count_nonzero(table != UNKNOWN)} positions, "
+          f"value of the empty board {table[0]}")
@@ -0,0 +1,67 @@
+import numpy as np
+
+class UCB1:
+    """value + c * sqrt(ln N / n), unvisited children first."""
+
+    def __init__(self, c=1.414):
+        self.c = c
+
+    def scores(self, tree, node, children, values):
+        n = tree.visits[children]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = values + self.c * np.sqrt(np.log(tree.visits[node]) / n)
+        return np.where(n > 0, scores, np.inf)
+
+
+class UCB1Tuned:
+    """
+    UCB1 with the exploration term scaled by an upper bound on each child's
+    reward variance, value + c * sqrt(ln N / n * min(variance_bound, V)). The
+    variance comes from the children's sums of squared rewards. The default
+    bound of 1 is the largest variance of rewards in [-1, 1].
+    """
+
+    def __init__(self, c=1.0, variance_bound=1.0):
+        self.c = c
+        self.variance_bound = variance_bound
+
+    def scores(self, tree, node, children, values):
+        n = tree.visits[children]
+        log_n = np.log(tree.visits[node])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            variance = np.maximum(tree.reward_sq[children] / n - values ** 2, 0) + np.sqrt(2 * log_n / n)
+            scores = values + self.c * np.sqrt(log_n / n * np.minimum(self.variance_bound, variance))
+        return np.where(n > 0, scores, np.inf)
+
+
+class PUCT:
+    """
+    value + c * P * sqrt(N) / (1 + n) with the prior P of each edge, see
+    SearchTree.edge_prior. Unvisited children count as a value of 0.
+    """
+
+    def __init__(self, c=1.414):
+        self.c = c
+
+    def scores(self, tree, node, children, values):
+        n = tree.visits[children]
+        first = tree.first_child[node]
+        priors = tree.edge_prior[first:first + len(children)]
+        values = np.where(n > 0, values, 0)
+        return values + self.c * priors * np.sqrt(tree.visits[node]) / (1 + n)
+
+
+POLICIES = {
+    'ucb1': UCB1,
+    'ucb1_tuned': UCB1Tuned,
+    'puct': PUCT,
+}
+
+def get_policy(policy, c):
+    # A policy name is built with the engine's exploration constant, a policy
+    # object is used as it is
+    if isinstance(policy, str):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown policy {policy!r}, expected one of {sorted(POLICIES)}")
+        return POLICIES[policy](c)
+    return policy
@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import threading
+import functools
+
+from collections import defaultdict
+
+def profile_target(profile=None):
+    """
+    What to do with the spans of a search: None when profiling is off, 'summary'
+    to log a summary table or the path of a Chrome trace file. Without an
+    explicit value the MCTS_PROFILE environment variable decides, '1' means
+    'summary' and any other non-empty value other than '0' is a trace path.
+    """
+    if profile is None:
+        profile = os.environ.get('MCTS_PROFILE', '')
+    if profile in ('', '0', False):
+        return None
+    if profile in ('1', True):
+        return 'summary'
+    return profile
+
+
+class PhaseProfiler:
+    """
+    Records a span with perf_counter_ns timestamps for every call of the
+    instrumented methods. Nothing is wrapped, and nothing costs anything,
+    until instrument() is called.
+    """
+
+    def __init__(self):
+        # (phase, thread id, start ns, end ns)
+        self.spans = []
+
+    def instrument(self, obj, phases):
+        # phases maps a phase name to the names of obj's methods that make it up,
+        # the wrappers shadow the methods on this instance only
+        for phase, names in phases.items():
+            for name in names:
+                setattr(obj, name, self._wrap(phase, getattr(obj, name)))
+
+    def _wrap(self, phase, method):
+        spans = self.spans
+        clock = time.perf_counter_ns
+        get_ident = threading.get_ident
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                spans.append((phase, get_ident(), start, clock()))
+        return wrapper
+
+    def clear(self):
+        self.spans.clear()
+
+    def _self_times(self):
+        # Time spent in each span minus the spans nested in it on the same thread
+        order = sorted(range(len(self.spans)),
+                       key=lambda i: (self.spans[i][1], self.spans[i][2], -self.spans[i][3]))
+        self_times = [end - start for _, _, start, end in self.spans]
+        stack = []
+        for i in order:
+            _, tid, start, end = self.spans[i]
+            while stack and (self.spans[stack[-1]][1] != tid or self.spans[stack[-1]][3] <= start):
+                stack.pop()
+            if stack:
+                self_times[stack[-1]] -= end - start
+            stack.append(i)
+        return self_times
+
+    def summary(self):
+        """Calls, total and self time per phase, sorted by self time."""
+        rows = defaultdict(lambda: {'calls': 0, 'total_ns': 0, 'self_ns': 0, 'max_ns': 0})
+        for (phase, _, start, end), self_ns in zip(self.spans, self._self_times()):
+            row = rows[phase]
+            row['calls'] += 1
+            row['total_ns'] += end - start
+            row['self_ns'] += self_ns
+            row['max_ns'] = max(row['max_ns'], end - start)
+
+        all_self_ns = sum(row['self_ns'] for row in rows.values()) or 1
+        summary = []
+        for phase, row in rows.items():
+            summary.append({'phase': phase,
+                            'calls': row['calls'],
+                            'total_ms': row['total_ns'] / 1e6,
+                            'self_ms': row['self_ns'] / 1e6,
+                            'mean_us': row['total_ns'] / row['calls'] / 1e3,
+                            'max_us': row['max_ns'] / 1e3,
+                            'share': row['self_ns'] / all_self_ns})
+        return sorted(summary, key=lambda row: -row['self_ms'])
+
+    def format_summary(self):
+        lines = [f"{'phase':12s} {'calls':>9s} {'total ms':>10s} {'self ms':>10s} "
+                 f"{'mean us':>9s} {'max us':>9s} {'share':>7s}"]
+        for row in self.summary():
+            lines.append(f"{row['phase']:12s} {row['calls']:9d} {row['total_ms']:10.2f} {row['self_ms']:10.2f} "
+                         f"{row['mean_us']:9.1f} {row['max_us']:9.1f} {row['share']:7.1%}")
+        return '\n'.join(lines)
+
+    def write_chrome_trace(self, path):
+        """Write the spans as complete events of a Chrome / Perfetto JSON trace."""
+        origin = min((start for _, _, start, _ in self.spans), default=0)
+        events = [{'name': phase,
+                   'cat': 'mcts',
+                   'ph': 'X',
+                   'ts': (start - origin) / 1e3,
+                   'dur': (end - start) / 1e3,
+                   'pid': os.getpid(),
+                   'tid': tid} for phase, tid, start, end in self.spans]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ns'}, f)
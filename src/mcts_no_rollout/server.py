@@ -0,0 +1,170 @@
+import json
+import asyncio
+import argparse
+import itertools
+
+from scheduler import SearchScheduler
+from tic_tac_toe import TTTBoard
+
+HELP = "commands: new [size [k [radius]]], play <row> <col>, go, board, metrics, help, quit"
+
+class GameServer:
+    """
+    Line protocol front end for the engine, one game session per connection.
+    Every request is one line, every reply is one line starting with 'ok' or
+    'error':
+
+        new [size [k [radius]]]   start a new game     -> ok new
+        play <row> <col>          play a move, the engine answers it
+                                  -> ok move <row> <col> [result X|O|draw]
+                                     or ok result X|O|draw when the game ended
+        go                        the engine plays the side to move
+        board                     -> ok <rows separated by /> <side to move>
+        metrics                   -> ok <JSON>
+        quit                      -> ok bye
+
+    Searches go to a SearchScheduler, so they run in its worker processes and
+    the event loop only ever waits on their futures.
+    """
+
+    def __init__(self, scheduler, iterations=1200, time_limit=None):
+        self.scheduler = scheduler
+        self.iterations = iterations
+        self.time_limit = time_limit
+        self._game_ids = itertools.count()
+        self._counters = {'connections': 0, 'sessions': 0, 'commands': 0, 'errors': 0, 'searching': 0}
+
+    async def serve_tcp(self, host='127.0.0.1', port=8765):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def serve_unix(self, path):
+        server = await asyncio.start_unix_server(self.handle, path)
+        async with server:
+            await server.serve_forever()
+
+    def metrics(self):
+        """Sessions and commands served, plus the scheduler's queue depth and search latencies."""
+        stats = self.scheduler.stats()
+        metrics = dict(self._counters)
+        metrics['queue_depth'] = stats['pending']
+        for name in ('completed', 'failed', 'latency_p50_ms', 'latency_p90_ms', 'latency_p99_ms', 'mean_queue_ms'):
+            metrics[f'search_{name}'] = stats[name]
+        return metrics
+
+    async def handle(self, reader, writer):
+        self._counters['connections'] += 1
+        self._counters['sessions'] += 1
+        session = {'game_id': next(self._game_ids), 'board': TTTBoard()}
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                words = line.decode().split()
+                if not words:
+                    continue
+                self._counters['commands'] += 1
+                try:
+                    reply = await self._dispatch(session, words)
+                except Exception as e:
+                    self._counters['errors'] += 1
+                    reply = f"error {e}"
+                writer.write((reply + '\n').encode())
+                await writer.drain()
+                if words[0] == 'quit':
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self._counters['sessions'] -= 1
+            self.scheduler.end_game(session['game_id'])
+            writer.close()
+
+    async def _dispatch(self, session, words):
+        command, args = words[0], words[1:]
+        board = session['board']
+        if command == 'new':
+            size, k, radius = (list(map(int, args)) + [3, None, None][len(args):])[:3]
+            self.scheduler.end_game(session['game_id'])
+            session['game_id'] = next(self._game_ids)
+            session['board'] = TTTBoard(size=size, k=k, radius=radius)
+            return "ok new"
+        if command == 'play':
+            if len(args) != 2:
+                raise ValueError("play needs a row and a column")
+            row, col = int(args[0]), int(args[1])
+            if _result(board) is not None:
+                raise ValueError("the game is over")
+            if not (0 <= row < board.size and 0 <= col < board.size) or board.get_marker(row, col) != board.empty:
+                raise ValueError(f"illegal move {row} {col}")
+            board = session['board'] = board.move(row, col)
+            if _result(board) is not None:
+                return f"ok result {_result(board)}"
+            return await self._engine_move(session)
+        if command == 'go':
+            if _result(board) is not None:
+                raise ValueError("the game is over")
+            return await self._engine_move(session)
+        if command == 'board':
+            rows = [''.join(str(board.get_marker(row, col)) for col in range(board.size))
+                    for row in range(board.size)]
+            return f"ok {'/'.join(rows)} {board.cur_player}"
+        if command == 'metrics':
+            return f"ok {json.dumps(self.metrics())}"
+        if command == 'help':
+            return f"ok {HELP}"
+        if command == 'quit':
+            return "ok bye"
+        raise ValueError(f"unknown command {command!r}, {HELP}")
+
+    async def _engine_move(self, session):
+        board = session['board']
+        self._counters['searching'] += 1
+        try:
+            future = self.scheduler.submit(session['game_id'], board, self.iterations, self.time_limit)
+            new_board = (await asyncio.wrap_future(future))['move']
+        finally:
+            self._counters['searching'] -= 1
+        session['board'] = new_board
+        row, col = _played_action(board, new_board)
+        result = _result(new_board)
+        return f"ok move {row} {col}" + ("" if result is None else f" result {result}")
+
+def _played_action(before, after):
+    # The one cell taken on after that is empty on before
+    occupied = lambda b: b.bitboards[b.first_player] | b.bitboards[b.second_player]
+    cell = (occupied(after) & ~occupied(before)).bit_length() - 1
+    return divmod(cell, before.size)
+
+def _result(board):
+    if board.winner is not None:
+        return str(board.winner)
+    if board.is_finished():
+        return 'draw'
+    return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve MCTS games over a line protocol.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', help="listen on this Unix socket instead of TCP")
+    parser.add_argument('--workers', type=int, default=None, help="search processes, one per CPU by default")
+    parser.add_argument('--slice', type=int, default=32, help="iterations per scheduling slice")
+    parser.add_argument('--iterations', type=int, default=1200, help="iterations per engine move")
+    parser.add_argument('--time-limit', type=float, default=None, help="seconds per engine move")
+    args = parser.parse_args(argv)
+
+    with SearchScheduler(n_workers=args.workers, slice_iterations=args.slice) as scheduler:
+        server = GameServer(scheduler, args.iterations, args.time_limit)
+        try:
+            if args.unix:
+                asyncio.run(server.serve_unix(args.unix))
+            else:
+                asyncio.run(server.serve_tcp(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    main()
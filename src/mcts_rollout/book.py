@@ -0,0 +1,84 @@
+import os
+import json
+
+from collections import OrderedDict
+
+class OpeningBook:
+    """
+    Moves chosen by earlier searches and the root children's statistics they
+    came from, keyed by the board's rules and the canonical encoding of the
+    position, so all symmetric images of a position share one entry. Moves are
+    stored on the canonical image and mapped back onto the board asking for
+    them.
+
+    At most max_size positions are kept, the least recently used one is
+    evicted first. With max_stones only positions with at most that many
+    stones are stored. With a path the book is read from that JSON file and
+    written back after every new entry.
+    """
+
+    def __init__(self, max_size=1024, max_stones=None, path=None):
+        self.max_size = max_size
+        self.max_stones = max_stones
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, state):
+        return self._key(state)[0] in self._entries
+
+    def _key(self, state):
+        key, transform = state.canonical()
+        return f"{state.size},{state.k},{state.radius},{key}", transform
+
+    def get(self, state):
+        """The stored (action, root_stats) for state in its own moves, None on a miss."""
+        key, transform = self._key(state)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        real = lambda action: state.transform_action(action, transform, inverse=True)
+        root_stats = [(real(stat[:2]),) + tuple(stat[2:]) for stat in entry['root_stats']]
+        return real(entry['action']), root_stats
+
+    def put(self, state, action, root_stats):
+        """
+        Store the action played from state and the root children's statistics
+        as (action, *numbers) tuples, in state's own moves.
+        """
+        n_stones = state.size * state.size - len(state.empty_cells)
+        if self.max_stones is not None and n_stones > self.max_stones:
+            return
+        key, transform = self._key(state)
+        canonical = lambda action: list(state.transform_action(action, transform))
+        self._entries[key] = {
+            'action': canonical(action),
+            'root_stats': [canonical(stat[0]) + list(stat[1:]) for stat in root_stats],
+        }
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        if self.path is not None:
+            self.save(self.path)
+
+    def save(self, path):
+        # Least recently used first, the order survives a round trip
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(list(self._entries.items()), f)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        with open(path) as f:
+            self._entries = OrderedDict(json.load(f))
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
@@ -1,11 +1,20 @@
+import time
 import random
+import logging
 import numpy as np
 import networkx as nx
 import matplotlib.pyplot as plt
 
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from networkx.drawing.nx_agraph import graphviz_layout
 
+from oracle import UNKNOWN, get_oracle
+from parallel import get_process_pool, split_budget, spawn_seeds
+from policies import get_policy
+from profiling import PhaseProfiler, profile_target
+from rollout import batched_rollout
+from tree import SearchTree
 from utils import ShellColors as sc
 
 import signal
@@ -14,6 +23,8 @@ def handler(signum, frame):
 # Set the signal handler
 signal.signal(signal.SIGINT, handler)
 
+logger = logging.getLogger(__name__)
+
 @dataclass
 class NodeData:
     DEPTH = 'depth'
@@ -22,6 +33,18 @@ class NodeData:
     REWARD = 'reward'
     Q = 'q'
     PLAYER = 'player'
+
+# Cheap counters kept by every engine, see MCTS.stats()
+COUNTERS = ('iterations', 'nodes_created', 'terminal_hits', 'rollouts', 'rollout_moves', 'book_hits',
+            'search_time')
+
+# The methods timed for each search phase when profiling is on
+PHASES = {
+    'selection': ['_select_node'],
+    'expansion': ['_expand_leaf_node'],
+    'simulation': ['_simulate'],
+    'backup': ['_backpropagate'],
+}
     
 class MCTS:
     def __init__(
@@ -29,157 +52,694 @@ class MCTS:
         state,
         budgets=1200, 
         exploration_constant=1.414,
+        policy='ucb1',
+        prior=None,
         max_depth=5,
+        n_rollouts=1,
+        transposition=False,
+        symmetry=False,
+        n_workers=1,
+        parallel='root',
+        virtual_loss=1,
+        solver=False,
+        oracle=False,
+        book=None,
+        seed=None,
+        verbose=True,
+        log_interval=None,
+        profile=None,
         visible_graph=False
     ):
         self.state = state
         self.budgets = budgets
         self.c = exploration_constant
+        # Selection policy, 'ucb1', 'ucb1_tuned', 'puct' or a policy object, see policies.py.
+        # prior(state, actions) gives the prior probabilities of a node's actions for PUCT,
+        # its untried actions are then expanded in order of prior.
+        self.policy = get_policy(policy, exploration_constant)
+        self.prior = prior
         self.max_depth = max_depth
+        # More than one rollout per leaf runs them as a single NumPy batch
+        self.n_rollouts = n_rollouts
+        # With a transposition table equal positions share one node and the tree becomes a DAG
+        self.transposition = transposition
+        self._table = {}
+        # With symmetry only one child per class of symmetric positions is expanded
+        self.symmetry = symmetry
+        # With more than one worker, 'root' runs independent searches in a process pool,
+        # 'tree' runs threads on this tree, steered apart by a virtual loss, and
+        # 'leaf' sends the n_rollouts rollouts of every leaf to a process pool
+        self.n_workers = n_workers
+        self.parallel = parallel
+        self.virtual_loss = virtual_loss
+        self._virtual_loss = 0
+        self._shared_tree = False
+        # The solver proves terminal nodes and their ancestors won, lost or drawn,
+        # skips solved children and stops once the root is solved
+        self.solver = solver
+        # On boards small enough to be solved exactly, see oracle.py, oracle='root'
+        # (or True) plays the perfect move without searching and oracle='leaf' keeps
+        # searching but replaces rollouts with the perfect-play result
+        self.oracle = 'root' if oracle is True else oracle
+        self._oracle = get_oracle(state) if oracle else None
+        # An OpeningBook shared between engines, see book.py. A position found in it
+        # is played straight away and every search adds its result to it.
+        self.book = book
+        self._seed = seed
+        self._random = random.Random(seed)
+        self._rng = np.random.default_rng(seed)
+
+        # verbose=False keeps the search loop silent, progress is then read
+        # through stats() or logged every log_interval seconds
+        self.verbose = verbose
+        self.log_interval = log_interval
+        self._counters = dict.fromkeys(COUNTERS, 0)
+        self._next_log = None
+        self._search_start = None
+
+        # Per-phase timings, switched on by profile or the MCTS_PROFILE environment
+        # variable, see profile_target(). Spans add up over every search.
+        self.profile = profile_target(profile)
+        self.profiler = None
+        if self.profile is not None:
+            self.profiler = PhaseProfiler()
+            self.profiler.instrument(self, PHASES)
         
         self.visible = visible_graph
         self.tree = self._create_tree(state)
+        self._root_transforms = None
 
     def _create_tree(self, state):
-        tree = nx.DiGraph()
-        tree.add_node(0)
-        tree.update(
-            nodes=[(0, {NodeData.DEPTH: 0,
-                        NodeData.STATE: state,
-                        NodeData.REWARD: 0,
-                        NodeData.Q: -np.inf,
-                        NodeData.VISITS: 0,
-                        NodeData.PLAYER: state.first_player})])
+        tree = SearchTree()
+        root = tree.add_node(state, depth=0, player=state.first_player)
+        self._counters['nodes_created'] += 1
+        if self.transposition:
+            self._table[self._table_key(state)] = root
         return tree
 
-    def search(self):
-        for i in range(self.budgets):
+    def search(self, time_limit=None, early_stop=False):
+        """
+        Run budgets iterations, or as many as fit in time_limit seconds when it
+        is given (budgets=None searches until the deadline). With early_stop
+        the search ends as soon as the most visited root child can no longer
+        be overtaken by another child within the remaining budget.
+        """
+        if self.budgets is None and time_limit is None:
+            raise ValueError("search needs budgets or a time_limit")
+        start = self._search_start = time.monotonic()
+        deadline = None if time_limit is None else start + time_limit
+        self._next_log = start + self.log_interval if self.log_interval else None
+        try:
+            move = self.instant_move()
+            if move is not None:
+                return move
+
+            if self.n_workers > 1:
+                if self.parallel == 'tree':
+                    return self._search_tree_parallel(deadline, early_stop)
+                if self.parallel == 'root':
+                    return self._search_root_parallel(time_limit, early_stop)
+
+            self._run_iterations(self.budgets, deadline, early_stop)
+
+            if self.visible:
+                self.visualize("Backpropagatge")
+                print("==="*20)
+
+            return self._get_best_action(root_node=0)
+        finally:
+            self._counters['search_time'] += time.monotonic() - start
+            self._search_start = None
+            if self.log_interval:
+                self._log_stats()
+            if self.profiler is not None:
+                self._report_profile()
+
+    def instant_move(self):
+        """The book or oracle move for the current state, None when it has to be searched."""
+        if self.book is not None:
+            move = self._book_move()
+            if move is not None:
+                return move
+        if self._oracle is not None and self.oracle == 'root':
+            return self._oracle_move()
+        return None
+
+    def step(self, budgets, deadline=None):
+        """
+        Run up to budgets more iterations on the current tree, fewer when the
+        deadline passes or the root is solved, and return how many ran. A
+        scheduler interleaves the steps of many games, see scheduler.py, and
+        reads the result with best_move().
+        """
+        start = self._search_start = time.monotonic()
+        try:
+            return self._run_iterations(budgets, deadline)
+        finally:
+            self._counters['search_time'] += time.monotonic() - start
+            self._search_start = None
+
+    def best_move(self):
+        return self._get_best_action(root_node=0)
+
+    def stats(self):
+        """
+        Counters accumulated over every search of this engine, plus the current
+        tree size and the rates derived from them.
+        """
+        stats = dict(self._counters)
+        if self._search_start is not None:
+            stats['search_time'] += time.monotonic() - self._search_start
+        stats['tree_nodes'] = len(self.tree)
+        stats['iterations_per_second'] = stats['iterations'] / stats['search_time'] if stats['search_time'] else 0.0
+        stats['mean_rollout_length'] = stats['rollout_moves'] / stats['rollouts'] if stats['rollouts'] else 0.0
+        return stats
+
+    def _log_stats(self):
+        stats = self.stats()
+        logger.info("iterations=%d nodes=%d terminal_hits=%d rollouts=%d mean_rollout_length=%.2f "
+                    "iterations_per_second=%.1f",
+                    stats['iterations'], stats['tree_nodes'], stats['terminal_hits'], stats['rollouts'],
+                    stats['mean_rollout_length'], stats['iterations_per_second'])
+
+    def _run_iterations(self, budgets, deadline=None, early_stop=False, scale=1):
+        # scale turns this caller's remaining iterations into the whole search's,
+        # for tree-parallel workers that share the root
+        start = time.monotonic()
+        i = 0
+        while budgets is None or i < budgets:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            if self.solver and not np.isnan(self.tree.proven[0]):
+                break
             # print(f"{sc.OKGREEN}Iteration : {i+1} {sc.ENDC}")
-            leaf_node = self._select_node(cur_node=0)
-            state = self.tree.nodes[leaf_node][NodeData.STATE]
-            visits = self.tree.nodes[leaf_node][NodeData.VISITS]
+            self._iterate()
+            i += 1
+            if self._next_log is not None and time.monotonic() >= self._next_log:
+                self._next_log += self.log_interval
+                self._log_stats()
+
+            if early_stop and self._is_decided(
+                    scale * self._remaining_iterations(i, budgets, start, deadline)):
+                break
+        return i
+
+    def _report_profile(self):
+        if self.profile == 'summary':
+            logger.info("search phases\n%s", self.profiler.format_summary())
+        else:
+            self.profiler.write_chrome_trace(self.profile)
+
+    def _remaining_iterations(self, done, budgets, start, deadline):
+        # Iterations left before the budget or the deadline, whichever comes first
+        remaining = np.inf if budgets is None else budgets - done
+        if deadline is not None:
+            now = time.monotonic()
+            rate = done / max(now - start, 1e-9)
+            remaining = min(remaining, rate * (deadline - now))
+        return remaining
 
+    def _is_decided(self, remaining):
+        # The most visited root child can no longer be overtaken. Untried root
+        # actions are competitors with no visits yet, and only a root with a single
+        # action at all is decided before its other children are expanded.
+        tree = self.tree
+        if tree.n_reserved[0] < 2:
+            return tree.n_reserved[0] == 1
+        visits = tree.visits[tree.children(0)]
+        if tree.n_untried(0):
+            visits = np.append(visits, 0)
+        second, first = np.partition(visits, -2)[-2:]
+        return first - second > remaining
+
+
+    def _iterate(self):
+        # A node can have several parents, so the backup follows the selected path
+        path = []
+        leaf_node = self._select_node(cur_node=0, path=path)
+        state = self.tree.states[leaf_node]
+        visits = self.tree.visits[leaf_node] - self._virtual_loss
+        counters = self._counters
+        counters['iterations'] += 1
+
+        if self.verbose:
             print(f"{sc.OKCYAN}Selected Node {leaf_node}{sc.ENDC}")
             print(state)
 
-            finished_game = state.evaluate_game()
-            if not finished_game and (visits != 0 or leaf_node == 0):
-                leaf_node = self._expand_leaf_node(leaf_node)
+        finished_game = state.evaluate_game()
+        if finished_game or state.is_finished():
+            counters['terminal_hits'] += 1
+        elif visits != 0 or leaf_node == 0:
+            expanded_node = self._expand_leaf_node(leaf_node)
+            if expanded_node != leaf_node:
+                self._add_virtual_loss(expanded_node)
+                path.append(expanded_node)
+            leaf_node = expanded_node
+            if self.verbose:
                 print(f"{sc.OKCYAN}Expanded Node {leaf_node}{sc.ENDC}")
-                print(self.tree.nodes[leaf_node][NodeData.STATE])
-            
-            winner = self._rollout(leaf_node)
-            self._backpropagate(leaf_node, winner)
-            
-            if self.visible:
-                if (i+1) % self.budgets == 0:
-                    self.visualize("Backpropagatge")
-                    print("==="*20)
+                print(self.tree.states[leaf_node])
+        if self.solver:
+            self._prove_terminal(leaf_node)
 
+        wins, n_games, n_moves = self._simulate(leaf_node)
+        counters['rollouts'] += n_games
+        counters['rollout_moves'] += n_moves
+        self._backpropagate(path, wins, n_games)
+
+    def _simulate(self, leaf_node):
+        # Wins per player, games played and moves played from the leaf
+        if self._oracle is not None and self.oracle == 'leaf':
+            # Positions the oracle does not know are played out as usual
+            winner = self._oracle.winner(self.tree.states[leaf_node])
+            if winner != UNKNOWN:
+                return ({winner: 1} if winner else {}), 1, 0
+        if self.n_workers > 1 and self.parallel == 'leaf':
+            return self._rollout_leaf_parallel(leaf_node)
+        if self.n_rollouts > 1:
+            return batched_rollout(self.tree.states[leaf_node], self.n_rollouts, self._rng)
+        winner, n_moves = self._rollout(leaf_node)
+        return ({winner: 1} if winner else {}), 1, n_moves
+
+    def _search_tree_parallel(self, deadline=None, early_stop=False):
+        # Every worker thread runs whole iterations on the shared tree. Nodes on a
+        # worker's path carry a virtual loss until its backup, so the others
+        # spread out over different branches instead of piling onto one.
+        self.tree.enable_locking()
+        self._virtual_loss = self.virtual_loss
+        self._shared_tree = True
+        try:
+            with ThreadPoolExecutor(max_workers=self.n_workers) as pool:
+                futures = [pool.submit(self._run_iterations, budgets, deadline, early_stop, self.n_workers)
+                           for budgets in split_budget(self.budgets, self.n_workers)]
+                for future in futures:
+                    future.result()
+        finally:
+            self._virtual_loss = 0
+            self._shared_tree = False
         return self._get_best_action(root_node=0)
 
-    def _select_node(self, cur_node):
-        children = [child for child in self.tree.neighbors(cur_node)]
-        if not children:
-            return cur_node
-        best_node = self._find_best_node_with_uct(children)
-        return self._select_node(best_node)
+    def _search_root_parallel(self, time_limit=None, early_stop=False):
+        n_workers = self.n_workers if self.budgets is None else min(self.n_workers, self.budgets)
+        kwargs = dict(exploration_constant=self.c,
+                      policy=self.policy,
+                      prior=self.prior,
+                      max_depth=self.max_depth,
+                      n_rollouts=self.n_rollouts,
+                      transposition=self.transposition,
+                      symmetry=self.symmetry,
+                      solver=self.solver,
+                      oracle=self.oracle)
 
-    def _find_best_node_with_uct(self, children):        
-        assert len(children) != 0
+        pool = get_process_pool(n_workers)
+        kwargs.update(verbose=False, profile=False)
+        futures = [pool.submit(_root_search_worker, self.state, budgets, seed, kwargs,
+                               time_limit, early_stop)
+                   for budgets, seed in zip(split_budget(self.budgets, n_workers),
+                                            spawn_seeds(self._seed, n_workers))]
 
-        ucts = []
-        for child in children:
-            w = self.tree.nodes[child][NodeData.REWARD]
-            n = self.tree.nodes[child][NodeData.VISITS]
-            total_n = self.tree.nodes[0][NodeData.VISITS]
+        # Only the root children's statistics come back from the workers
+        # along with their counters, the search time is measured here
+        visits, rewards = {}, {}
+        for future in futures:
+            root_stats, counters = future.result()
+            for action, n, w in root_stats:
+                visits[action] = visits.get(action, 0) + n
+                rewards[action] = rewards.get(action, 0) + w
+            for name in COUNTERS:
+                if name != 'search_time':
+                    self._counters[name] += counters[name]
 
-            if n == 0:
-                uct = float('inf')
-            else:
-                exploitation = w / n
-                exploration = np.sqrt(np.log(total_n) / n)
-                uct = exploitation + self.c * exploration
-            ucts.append(uct)
+        actions = list(visits)
+        qs = [rewards[action] / visits[action] if visits[action] else -np.inf for action in actions]
+        if self.verbose:
+            print(f"Reward: {[rewards[action] for action in actions]}")
+            print(f"Q : {qs}")
+            print(f"Visits: {[visits[action] for action in actions]}")
+        best_action = actions[np.argmax(qs)]
+        if self.book is not None:
+            self.book.put(self.state, best_action, [(action, visits[action], rewards[action]) for action in actions])
+        return self.state.move(*best_action)
+
+    def _root_stats(self, root_node=0):
+        children = self.tree.children(root_node)
+        return list(zip(self.tree.child_actions(root_node),
+                        self.tree.visits[children].tolist(),
+                        self.tree.reward[children].tolist()))
+
+    def _select_node(self, cur_node, path):
+        # Descend through fully expanded nodes only, a node with untried
+        # actions gets a new child first
+        tree = self.tree
+        while True:
+            self._add_virtual_loss(cur_node)
+            path.append(cur_node)
+            n_children = tree.n_children[cur_node]
+            if not n_children or n_children < tree.n_reserved[cur_node]:
+                return cur_node
+            cur_node = self._find_best_child(cur_node, tree.children(cur_node))
+
+    def _find_best_child(self, cur_node, children):
+        assert len(children) != 0
 
-        best_node_idx = np.argmax(ucts)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = self.tree.reward[children] / self.tree.visits[children]
+        scores = self.policy.scores(self.tree, cur_node, children, values)
+        if self.solver:
+            # Solved children need no more search, unless nothing else is left
+            unsolved = np.isnan(self.tree.proven[children])
+            if unsolved.any():
+                scores = np.where(unsolved, scores, -np.inf)
+
+        best_node_idx = np.argmax(scores)
         best_node = children[best_node_idx]
         return best_node
 
     def _expand_leaf_node(self, leaf_node):
-        leaf_state = self.tree.nodes[leaf_node][NodeData.STATE]
-        possible_states = leaf_state.get_all_possible_states()
-        depth = self.tree.nodes[leaf_node][NodeData.DEPTH]
-
-        expanded_node = leaf_node
-        if possible_states and depth < self.max_depth:
-            for possible_state in possible_states:
-                new_node = self.tree.number_of_nodes()
-                self.tree.add_node(new_node)
-                self.tree.update(
-                    nodes=[(new_node, {NodeData.DEPTH: depth+1,
-                                       NodeData.STATE: possible_state,
-                                       NodeData.REWARD: 0,
-                                       NodeData.Q: -np.inf,
-                                       NodeData.VISITS: 0,
-                                       NodeData.PLAYER: possible_state.next_player})])
-                self.tree.add_edge(leaf_node, new_node)
-            expanded_node = random.choice([child for child in self.tree.neighbors(leaf_node)])
-        return expanded_node
+        # Adds one child per call. The node's actions are shuffled once into its
+        # edge block and taken from there one at a time.
+        tree = self.tree
+        leaf_state = tree.states[leaf_node]
+
+        with tree.lock:
+            if tree.first_child[leaf_node] < 0:
+                # No edge block at the depth limit, so the node can still be
+                # expanded once advance() makes it shallower
+                if tree.depth[leaf_node] >= self.max_depth:
+                    return leaf_node
+                possible_actions = self._unique_actions(leaf_state, leaf_state.get_all_possible_actions())
+                self._random.shuffle(possible_actions)
+                possible_actions, priors = self._order_by_prior(leaf_state, possible_actions)
+                tree.reserve_children(leaf_node, len(possible_actions), possible_actions, priors)
+
+            # Another worker may have taken the last untried action since this leaf was selected
+            if not tree.n_untried(leaf_node):
+                children = tree.children(leaf_node)
+                return self._random.choice(children) if len(children) else leaf_node
+
+            possible_action = tree.untried_action(leaf_node)
+            if self.transposition:
+                key = self._table_key(leaf_state, possible_action)
+                node = self._table.get(key)
+                if node is not None:
+                    tree.link(leaf_node, node, possible_action)
+                    return node
+            possible_state = leaf_state.move(*possible_action)
+            node = tree.add_child(leaf_node, possible_state, possible_action,
+                                  player=possible_state.next_player)
+            self._counters['nodes_created'] += 1
+            if self.transposition:
+                self._table[key] = node
+        return node
         
+    def _order_by_prior(self, state, actions):
+        # Most likely actions first, the sort is stable so ties keep their shuffled order
+        if self.prior is None or not actions:
+            return actions, None
+        priors = np.asarray(self.prior(state, actions), dtype=np.float32)
+        order = np.argsort(-priors, kind='stable')
+        return [actions[i] for i in order], priors[order]
+
+    def advance(self, state):
+        """
+        Re-root the search at state, one move after the current root. The
+        matching child keeps its subtree and statistics, the rest of the tree
+        is dropped. Without a matching child the search starts over. The tree
+        is kept as it is when state is the current root.
+        """
+        root_state = self.tree.states[0]
+        key = self._table_key(state)
+        new_root = 0 if self._table_key(root_state) == key else None
+        if new_root is None:
+            for child, action in zip(self.tree.children(0), self.tree.child_actions(0)):
+                if self._table_key(root_state, action) == key:
+                    new_root = int(child)
+                    break
+
+        self.state = state
+        self._root_transforms = None
+        if new_root is None:
+            self._table = {}
+            self.tree = self._create_tree(state)
+            return
+
+        if new_root:
+            self.tree, mapping = self.tree.subtree(new_root)
+            if self.transposition:
+                self._table = {key: int(mapping[node]) for key, node in self._table.items()
+                               if mapping[node] >= 0}
+        if self.tree.states[0] is None:
+            self.tree.states[0] = state
+        # With symmetry the kept node may hold a symmetric image of the real board,
+        # remember how to map its moves back, see _real_action()
+        if self.tree.states[0].hash != state.hash:
+            self._root_transforms = (self.tree.states[0].canonical()[1], state.canonical()[1])
+
+    def save_tree(self, path):
+        """Write the search tree to path, see SearchTree.save()."""
+        root_state = self.tree.states[0]
+        meta = {'size': root_state.size, 'k': root_state.k, 'radius': root_state.radius}
+        self.tree.save(path, lambda state: state.to_bytes(), meta)
+
+    def load_tree(self, path):
+        """
+        Continue searching from a tree written by save_tree(). The tree must be
+        rooted at the current state, or at a symmetric image of it with symmetry
+        on. The file is memory mapped, see SearchTree.load().
+        """
+        board_cls = type(self.state)
+        tree = SearchTree.load(path, lambda data, meta: board_cls.from_bytes(data, **meta))
+        root_state = tree.states[0]
+        if self._table_key(root_state) != self._table_key(self.state):
+            raise ValueError(f"the tree in {path} is not rooted at the current state")
+
+        self.tree = tree
+        self._root_transforms = None
+        if root_state.hash != self.state.hash:
+            self._root_transforms = (root_state.canonical()[1], self.state.canonical()[1])
+        if self.transposition:
+            self._rebuild_table()
+
+    def _rebuild_table(self):
+        # Every node is the child of an edge, except the root
+        tree = self.tree
+        self._table = {self._table_key(tree.states[0]): 0}
+        for node in np.flatnonzero(tree.n_children[:tree.n_nodes]).tolist():
+            state = tree.states[node]
+            for child, action in zip(tree.children(node).tolist(), tree.child_actions(node)):
+                self._table[self._table_key(state, action)] = child
+
+    def _real_action(self, action):
+        if self._root_transforms is None:
+            return action
+        root_transform, real_transform = self._root_transforms
+        action = self.tree.states[0].transform_action(action, root_transform)
+        return self.state.transform_action(action, real_transform, inverse=True)
+
+    def _table_key(self, state, action=None):
+        # With symmetry on, all symmetric images of a position share one table entry
+        if self.symmetry:
+            return (state.canonical_after(*action) if action else state.canonical())[0]
+        return state.hash_after(*action) if action else state.hash
+
+    def _unique_actions(self, state, actions):
+        # Keep one action per class of symmetric child positions
+        if not self.symmetry:
+            return actions
+        seen = set()
+        unique_actions = []
+        for action in actions:
+            key, _ = state.canonical_after(*action)
+            if key not in seen:
+                seen.add(key)
+                unique_actions.append(action)
+        return unique_actions
+
     def _rollout(self, leaf_node):
-        state = self.tree.nodes[leaf_node][NodeData.STATE]
+        # Play out in place on the leaf state and undo the moves afterwards,
+        # tree-parallel workers may share a leaf so they play out on a copy
+        state = self.tree.states[leaf_node]
+        if self._shared_tree:
+            state = state.copy()
+        n_moves = 0
         # print(f"{sc.OKCYAN}Rollout{sc.ENDC}")
         while not state.evaluate_game():
-            possible_states = state.get_all_possible_states()
-            if possible_states:
-                state = random.choice(possible_states)
+            if state.empty_cells:
+                cell = self._random.choice(state.empty_cells)
+                state.push(*divmod(cell, state.size))
+                n_moves += 1
             else:
+                break
+
+        winner = state.winner
+        for _ in range(n_moves):
+            state.pop()
+
+        if self.verbose:
+            if winner is None:
                 print(f"{sc.OKBLUE}************* Draw !!! *************{sc.ENDC}")
+            else:
+                print(f"{sc.OKBLUE}************* Winner is {winner}!!! *************{sc.ENDC}")
+        return winner, n_moves
+
+    def _rollout_leaf_parallel(self, leaf_node):
+        # The workers of the shared pool stay warm across iterations and moves,
+        # only the encoded board and the win counts cross process boundaries
+        state = self.tree.states[leaf_node]
+        code = state.encode()
+        n_workers = min(self.n_workers, self.n_rollouts)
+
+        pool = get_process_pool(n_workers)
+        futures = [pool.submit(_leaf_rollout_worker, type(state), code, n_rollouts,
+                               self._random.getrandbits(64))
+                   for n_rollouts in split_budget(self.n_rollouts, n_workers)]
+
+        wins, n_moves = {}, 0
+        for future in futures:
+            worker_wins, worker_moves = future.result()
+            for player, n in worker_wins.items():
+                wins[player] = wins.get(player, 0) + n
+            n_moves += worker_moves
+        return wins, self.n_rollouts, n_moves
+
+    def _backpropagate(self, path, wins, n_games=1):
+        # Only the nodes on the selected path are updated. A transposition node
+        # shares its statistics with all of its parents, but each parent only
+        # counts the visits that went through it.
+        proving = self.solver
+        for node in reversed(path):
+            self._update_node(node, wins, n_games)
+            # Only a node below that was just solved can solve its parent
+            if proving:
+                proving = self._prove(node)
+
+    def _prove_terminal(self, node):
+        # Values are seen from the player who moved into the node, like its reward
+        state = self.tree.states[node]
+        if not np.isnan(self.tree.proven[node]):
+            return
+        winner = UNKNOWN
+        if self._oracle is not None and self.oracle == 'leaf':
+            winner = self._oracle.winner(state)
+        if winner == UNKNOWN:
+            if not (state.evaluate_game() or state.is_finished()):
                 return
+            winner = state.winner
+        # Under the node's lock, a tree-parallel grow would otherwise drop the write
+        with self.tree.node_lock(node):
+            self.tree.proven[node] = 0 if winner is None else (1 if winner == self.tree.get_player(node) else -1)
+
+    def _book_move(self):
+        # The move the book holds for the current state, None on a miss
+        entry = self.book.get(self.state)
+        if entry is None:
+            return None
+        action, _ = entry
+        self._counters['book_hits'] += 1
+        if self.verbose:
+            print(f"{sc.OKGREEN}Book move {action}{sc.ENDC}")
+        return self.state.move(*action)
+
+    def _oracle_move(self):
+        # A random one of the perfect moves, None when the oracle does not know the position
+        actions = self._oracle.best_actions(self.state)
+        if not actions:
+            return None
+        action = self._random.choice(actions)
+        if self.verbose:
+            print(f"{sc.OKGREEN}Oracle move {action} out of {actions}{sc.ENDC}")
+        return self.state.move(*action)
 
-        print(f"{sc.OKBLUE}************* Winner is {state.winner}!!! *************{sc.ENDC}")
-        return state.winner
+    def _prove(self, node):
+        # A node is lost for the player who moved into it when the player to move
+        # there has a winning child, otherwise it is worth the opposite of its best
+        # child once every action has a proven child. Returns whether node is solved.
+        tree = self.tree
+        if not np.isnan(tree.proven[node]):
+            return True
+        n_children = tree.n_children[node]
+        if not n_children:
+            return False
+        values = tree.proven[tree.children(node)]
+        if (values == 1).any():
+            value = -1
+        elif n_children == tree.n_reserved[node] and not np.isnan(values).any():
+            value = 0 - values.max()
+        else:
+            return False
+        with tree.node_lock(node):
+            tree.proven[node] = value
+        return True
 
-    def _backpropagate(self, leaf_node, winner):
-        cur_node = self.tree.nodes[leaf_node]
-        self._update_node(cur_node, winner)
+    def _update_node(self, cur_node, wins, n_games):
+        # wins maps each player to the number of games it won, the rest are draws
+        tree = self.tree
+        won = wins.get(tree.get_player(cur_node), 0)
+        lost = sum(wins.values()) - won
+        with tree.node_lock(cur_node):
+            # Replace this worker's virtual loss with the real result
+            tree.visits[cur_node] += n_games - self._virtual_loss
+            tree.reward[cur_node] += won - lost + self._virtual_loss
+            # Every game won or lost adds a squared reward of 1, draws add 0
+            tree.reward_sq[cur_node] += won + lost
+            tree.q[cur_node] = tree.reward[cur_node] / tree.visits[cur_node]
 
-        parent_nodes = [node for node in self.tree.predecessors(leaf_node)]
-        if not parent_nodes:
+    def _add_virtual_loss(self, cur_node):
+        if not self._virtual_loss:
             return
-        leaf_node = parent_nodes[0]
-        self._backpropagate(leaf_node, winner)
-
-    def _update_node(self, cur_node, winner):
-        cur_node[NodeData.VISITS] += 1
-        if winner:
-            if cur_node[NodeData.PLAYER] == winner:
-                cur_node[NodeData.REWARD] += 1
-            if cur_node[NodeData.PLAYER] != winner:
-                cur_node[NodeData.REWARD] -= 1
-        cur_node[NodeData.Q] = cur_node[NodeData.REWARD] / cur_node[NodeData.VISITS]
+        tree = self.tree
+        with tree.node_lock(cur_node):
+            tree.visits[cur_node] += self._virtual_loss
+            tree.reward[cur_node] -= self._virtual_loss
 
     def _get_best_action(self, root_node=0):
-        children = [child for child in self.tree.neighbors(root_node)]
-        best_idx = np.argmax([self.tree.nodes[child][NodeData.Q] for child in children])
-        print(f"Reward: {[self.tree.nodes[child][NodeData.REWARD] for child in children]}")
-        print(f"Q : {[self.tree.nodes[child][NodeData.Q] for child in children]}")
-        print(f"Visits: {[self.tree.nodes[child][NodeData.VISITS] for child in children]}")
-        return self.tree.nodes[children[best_idx]][NodeData.STATE]
+        children = self.tree.children(root_node)
+        if not len(children) and self._oracle is not None:
+            # A root the oracle proved as a leaf, the solver stops before
+            # expanding it, so its move comes from the oracle too
+            return self._oracle_move()
+        best_idx = np.argmax(self._move_values(children))
+        if self.verbose:
+            print(f"Reward: {self.tree.reward[children].tolist()}")
+            print(f"Q : {self.tree.q[children].tolist()}")
+            print(f"Visits: {self.tree.visits[children].tolist()}")
+        # Edge actions are moves on the root's own board, even when the child node
+        # holds a symmetric image or a transposition of the resulting position
+        best_action = self._real_action(self.tree.child_actions(root_node)[best_idx])
+        if self.book is not None:
+            self.book.put(self.state, best_action, [(self._real_action(action), n, w)
+                                                    for action, n, w in self._root_stats(root_node)])
+        return self.state.move(*best_action)
+
+    def _move_values(self, children):
+        # Proven values override the averages, a proven win beats any unproven child
+        values = self.tree.q[children]
+        if self.solver:
+            proven = self.tree.proven[children]
+            values = np.where(np.isnan(proven), values, proven)
+            values[proven == 1] = np.inf
+        return values
 
     def visualize(self, title):
-        # visited_nodes = [n for n in self.tree.nodes if self.tree.nodes[n][NodeData.VISITS] > 0]
-        # visited_tree = self.tree.subgraph(visited_nodes)
-        labels = { n: 'D:{:d}\nV:{:d}\nR:{:d}\nQ:{:.2f}\nP:{:s}'.format(
-                self.tree.nodes[n][NodeData.DEPTH], 
-                self.tree.nodes[n][NodeData.VISITS], 
-                self.tree.nodes[n][NodeData.REWARD], 
-                self.tree.nodes[n][NodeData.Q],
-                self.tree.nodes[n][NodeData.PLAYER],) for n in self.tree.nodes}
+        # The networkx view is only built on demand, the search itself never touches it.
+        graph = self.tree.to_networkx()
+        labels = { n: 'D:{:d}\nV:{:d}\nR:{:g}\nQ:{:.2f}\nP:{:s}'.format(
+                graph.nodes[n][NodeData.DEPTH], 
+                graph.nodes[n][NodeData.VISITS], 
+                graph.nodes[n][NodeData.REWARD], 
+                graph.nodes[n][NodeData.Q],
+                graph.nodes[n][NodeData.PLAYER],) for n in graph.nodes}
 
         plt.figure(title, figsize=(12, 8),)
-        pos = graphviz_layout(self.tree, prog='dot')
-        nx.draw(self.tree, pos, labels=labels, node_shape="s", node_color="none",
+        pos = graphviz_layout(graph, prog='dot')
+        nx.draw(graph, pos, labels=labels, node_shape="s", node_color="none",
                 bbox=dict(facecolor="skyblue", edgecolor='black', boxstyle='round,pad=0.1'))
-        plt.show()
\ No newline at end of file
+        plt.show()
+
+def _leaf_rollout_worker(board_cls, code, n_rollouts, seed):
+    wins, _, n_moves = batched_rollout(board_cls.decode(code), n_rollouts, np.random.default_rng(seed))
+    return wins, n_moves
+
+def _root_search_worker(state, budgets, seed, kwargs, time_limit=None, early_stop=False):
+    mcts = MCTS(state, budgets=budgets, seed=seed, **kwargs)
+    mcts.search(time_limit, early_stop)
+    return mcts._root_stats(), mcts._counters
@@ -0,0 +1,22 @@
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+_POOLS = {}
+
+def get_process_pool(n_workers):
+    """Process pool shared by every search so its workers stay warm across moves."""
+    pool = _POOLS.get(n_workers)
+    if pool is None:
+        pool = ProcessPoolExecutor(max_workers=n_workers)
+        _POOLS[n_workers] = pool
+    return pool
+
+def split_budget(budget, n_parts):
+    # No budget at all (a time limited search) stays unlimited in every part
+    if budget is None:
+        return [None] * n_parts
+    return [budget // n_parts + (i < budget % n_parts) for i in range(n_parts)]
+
+def spawn_seeds(seed, n_seeds):
+    return [int(s) for s in np.random.SeedSequence(seed).generate_state(n_seeds)]
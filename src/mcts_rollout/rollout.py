@@ -0,0 +1,61 @@
+import numpy as np
+
+_LINE_MATRICES = {}
+
+def get_line_matrix(win_masks, n_cells):
+    """(n_lines, n_cells) 0/1 matrix of the board's winning lines."""
+    key = (win_masks, n_cells)
+    lines = _LINE_MATRICES.get(key)
+    if lines is None:
+        lines = np.array([[mask >> cell & 1 for cell in range(n_cells)] for mask in win_masks],
+                         dtype=np.float32)
+        _LINE_MATRICES[key] = lines
+    return lines
+
+def batched_rollout(state, n_rollouts, rng):
+    """
+    Play n_rollouts independent random games from state at once.
+
+    Every game is a row of an (n_rollouts, n_cells) int8 array with +1 for the
+    first player, -1 for the second player and 0 for empty cells. All unfinished
+    games make one random move per ply and wins are found with a single matrix
+    product against the line masks.
+
+    Returns the number of games won by each player, the number of games
+    played, the rest of the games are draws, and the number of moves played
+    over all games.
+    """
+    if state.evaluate_game():
+        wins = {state.winner: n_rollouts}
+        return wins, n_rollouts, 0
+
+    n_cells = state.size * state.size
+    lines = get_line_matrix(state.win_masks, n_cells)
+    line_lengths = lines.sum(axis=1)
+
+    boards = np.repeat(state.to_array()[np.newaxis], n_rollouts, axis=0)
+    results = np.zeros(n_rollouts, dtype=np.int8)
+    active = np.arange(n_rollouts)
+    sign = 1 if state.cur_player == state.first_player else -1
+    n_moves = 0
+
+    for _ in range(len(state.empty_cells)):
+        n_moves += len(active)
+        games = boards[active]
+        # A uniform random key per empty cell, the argmax is a uniform random empty cell
+        keys = rng.random(games.shape)
+        keys[games != 0] = -1
+        games[np.arange(len(active)), keys.argmax(axis=1)] = sign
+        boards[active] = games
+
+        counts = (games == sign).astype(np.float32) @ lines.T
+        won = (counts == line_lengths).any(axis=1)
+        results[active[won]] = sign
+        active = active[~won]
+        if not len(active):
+            break
+        sign = -sign
+
+    wins = {state.first_player: int(np.count_nonzero(results == 1)),
+            state.second_player: int(np.count_nonzero(results == -1))}
+    return wins, n_rollouts, n_moves
@@ -0,0 +1,253 @@
+import os
+import sys
+import time
+import random
+import threading
+import multiprocessing
+import numpy as np
+
+from queue import Empty
+from collections import deque
+from concurrent.futures import Future
+
+from mcts import MCTS
+
+class SearchScheduler:
+    """
+    Serves the searches of many independent games from a pool of worker
+    processes.
+
+    Every game lives on one worker, the least busy one when its first request
+    comes in, and keeps its engine there between moves so the tree is reused,
+    see MCTS.advance(). A worker runs its pending searches round-robin in
+    slices of slice_iterations iterations, so a long search never holds up the
+    games sharing its worker for more than one slice. Each request has its own
+    budget of iterations, of seconds, or both.
+    """
+
+    def __init__(self, n_workers=None, slice_iterations=32, latency_window=10000, **engine_kwargs):
+        self.n_workers = n_workers or os.cpu_count()
+        self.slice_iterations = slice_iterations
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._futures = {}
+        self._games = {}
+        self._busy_games = set()
+        self._worker_games = [0] * self.n_workers
+        self._counters = {'submitted': 0, 'completed': 0, 'failed': 0, 'iterations': 0}
+        self._latencies = deque(maxlen=latency_window)
+        self._queue_waits = deque(maxlen=latency_window)
+
+        self._results = multiprocessing.Queue()
+        self._inboxes = [multiprocessing.Queue() for _ in range(self.n_workers)]
+        self._workers = [multiprocessing.Process(target=_worker_loop,
+                                                 args=(inbox, self._results, engine_kwargs, slice_iterations),
+                                                 daemon=True)
+                         for inbox in self._inboxes]
+        for worker in self._workers:
+            worker.start()
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, game_id, state, iterations=None, time_limit=None):
+        """
+        Search state for the move to play in game_id. The search stops after
+        iterations iterations or time_limit seconds from when its worker gets
+        the request, whichever comes first. Returns a Future of a dict with the
+        next board under 'move' and the request's latency breakdown. A game has
+        at most one search pending at a time.
+        """
+        if iterations is None and time_limit is None:
+            raise ValueError("a search request needs iterations or a time_limit")
+        with self._lock:
+            if game_id in self._busy_games:
+                raise ValueError(f"game {game_id!r} already has a search pending")
+            worker = self._games.get(game_id)
+            if worker is None:
+                worker = int(np.argmin(self._worker_games))
+                self._games[game_id] = worker
+                self._worker_games[worker] += 1
+            request_id = self._next_id
+            self._next_id += 1
+            future = Future()
+            self._futures[request_id] = (future, game_id, time.monotonic())
+            self._busy_games.add(game_id)
+            self._counters['submitted'] += 1
+        self._inboxes[worker].put(('search', request_id, game_id, state, iterations, time_limit))
+        return future
+
+    def search(self, game_id, state, iterations=None, time_limit=None):
+        # Blocking submit(), the next board
+        return self.submit(game_id, state, iterations, time_limit).result()['move']
+
+    def end_game(self, game_id):
+        """Drop the engine of a finished game from its worker."""
+        with self._lock:
+            worker = self._games.pop(game_id, None)
+            if worker is None:
+                return
+            self._worker_games[worker] -= 1
+        self._inboxes[worker].put(('end', game_id))
+
+    def _collect(self):
+        while True:
+            message = self._results.get()
+            if message is None:
+                return
+            kind, request_id, payload = message
+            with self._lock:
+                future, game_id, submitted = self._futures.pop(request_id)
+                self._busy_games.discard(game_id)
+                if kind == 'error':
+                    self._counters['failed'] += 1
+                else:
+                    payload['game_id'] = game_id
+                    payload['latency_ms'] = (time.monotonic() - submitted) * 1000
+                    self._counters['completed'] += 1
+                    self._counters['iterations'] += payload['iterations']
+                    self._latencies.append(payload['latency_ms'])
+                    self._queue_waits.append(payload['queue_ms'])
+            if kind == 'error':
+                future.set_exception(payload)
+            else:
+                future.set_result(payload)
+
+    def stats(self):
+        """Request counters plus latency percentiles over the latest requests."""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['pending'] = len(self._futures)
+            stats['games'] = len(self._games)
+            latencies = np.array(self._latencies)
+            queue_waits = np.array(self._queue_waits)
+        for p in (50, 90, 99):
+            stats[f'latency_p{p}_ms'] = float(np.percentile(latencies, p)) if len(latencies) else 0.0
+        stats['mean_queue_ms'] = float(queue_waits.mean()) if len(queue_waits) else 0.0
+        return stats
+
+    def close(self):
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._results.put(None)
+        self._collector.join()
+
+
+class _Job:
+    def __init__(self, request_id, engine, iterations, time_limit):
+        self.request_id = request_id
+        self.engine = engine
+        self.iterations = iterations
+        self.received = time.monotonic()
+        self.deadline = None if time_limit is None else self.received + time_limit
+        self.started = None
+        self.done = 0
+        self.n_slices = 0
+
+    def result(self, move):
+        now = time.monotonic()
+        started = self.started or now
+        return {'move': move,
+                'iterations': self.done,
+                'slices': self.n_slices,
+                'queue_ms': (started - self.received) * 1000,
+                'search_ms': (now - started) * 1000}
+
+def _worker_loop(inbox, results, engine_kwargs, slice_iterations):
+    engines = {}
+    jobs = deque()
+    while True:
+        # Wait for work only when there is nothing to search, otherwise take
+        # whatever arrived since the last slice
+        messages = []
+        if not jobs:
+            messages.append(inbox.get())
+        while True:
+            try:
+                messages.append(inbox.get_nowait())
+            except Empty:
+                break
+
+        for message in messages:
+            if message is None:
+                return
+            if message[0] == 'end':
+                engines.pop(message[1], None)
+                continue
+            _, request_id, game_id, state, iterations, time_limit = message
+            try:
+                engine = engines.get(game_id)
+                if engine is None:
+                    engine = engines[game_id] = MCTS(state=state, **{'verbose': False, **engine_kwargs})
+                else:
+                    engine.advance(state)
+                job = _Job(request_id, engine, iterations, time_limit)
+                move = engine.instant_move()
+                if move is not None:
+                    engine.advance(move)
+            except Exception as e:
+                results.put(('error', request_id, e))
+                continue
+            if move is not None:
+                results.put(('done', request_id, job.result(move)))
+            else:
+                jobs.append(job)
+
+        if not jobs:
+            continue
+        job = jobs.popleft()
+        try:
+            if job.started is None:
+                job.started = time.monotonic()
+            n = slice_iterations if job.iterations is None else min(slice_iterations, job.iterations - job.done)
+            done = job.engine.step(n, job.deadline)
+            job.done += done
+            job.n_slices += 1
+            finished = (done < n
+                        or job.iterations is not None and job.done >= job.iterations
+                        or job.deadline is not None and time.monotonic() >= job.deadline)
+            if finished:
+                # Re-root at the played move right away, the game's next request
+                # is one reply further and advance() only looks one move down
+                move = job.engine.best_move()
+                job.engine.advance(move)
+                results.put(('done', job.request_id, job.result(move)))
+            else:
+                jobs.append(job)
+        except Exception as e:
+            results.put(('error', job.request_id, e))
+
+if __name__ == "__main__":
+    from tic_tac_toe import TTTBoard
+
+    # Random players against the engine in n_games games at once
+    n_games = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    n_workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    rng = random.Random(0)
+    with SearchScheduler(n_workers=n_workers) as scheduler:
+        boards = {game: TTTBoard().move(*rng.choice(TTTBoard().get_all_possible_actions()))
+                  for game in range(n_games)}
+        start = time.monotonic()
+        while boards:
+            futures = {game: scheduler.submit(game, board, iterations=400) for game, board in boards.items()}
+            for game, future in futures.items():
+                board = future.result()['move']
+                if board.winner is not None or board.is_finished():
+                    scheduler.end_game(game)
+                    del boards[game]
+                    continue
+                boards[game] = board.move(*rng.choice(board.get_all_possible_actions()))
+                if boards[game].winner is not None or boards[game].is_finished():
+                    scheduler.end_game(game)
+                    del boards[game]
+        stats = scheduler.stats()
+    print(f"{stats['completed']} searches in {time.monotonic() - start:.2f}s, "
+          f"latency p50 {stats['latency_p50_ms']:.1f} ms p90 {stats['latency_p90_ms']:.1f} ms "
+          f"p99 {stats['latency_p99_ms']:.1f} ms, mean queue {stats['mean_queue_ms']:.1f} ms")
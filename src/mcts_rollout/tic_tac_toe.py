@@ -1,8 +1,10 @@
 import re
 import enum
+import random
+import numpy as np
 
-from copy import deepcopy
 from mcts import *
+from book import OpeningBook
 
 class Marker:
     X = 'X'
@@ -14,8 +16,125 @@ class GAME_RESULT(enum.Enum):
     LOSE = 1
     DRAW = 2
 
+_WIN_MASKS = {}
+
+def get_win_masks(size, k=None):
+    """
+    Bit masks of every k cells in a row, column or diagonal of a size x size
+    board. k defaults to size, a whole row, column or diagonal.
+    """
+    k = size if k is None else k
+    masks = _WIN_MASKS.get((size, k))
+    if masks is None:
+        lines = []
+        span = range(size - k + 1)
+        for row in range(size):
+            for col in span:
+                lines.append([(row, col + i) for i in range(k)])
+        for col in range(size):
+            for row in span:
+                lines.append([(row + i, col) for i in range(k)])
+        for row in span:
+            for col in span:
+                lines.append([(row + i, col + i) for i in range(k)])
+        for row in span:
+            for col in span:
+                lines.append([(row + i, size - col - i - 1) for i in range(k)])
+
+        masks = tuple(sum(1 << (row * size + col) for row, col in line) for line in lines)
+        _WIN_MASKS[(size, k)] = masks
+    return masks
+
+_CELL_WIN_MASKS = {}
+
+def get_cell_win_masks(size, k=None):
+    """The win masks through each cell, the only ones a stone on that cell can complete."""
+    k = size if k is None else k
+    cell_masks = _CELL_WIN_MASKS.get((size, k))
+    if cell_masks is None:
+        masks = get_win_masks(size, k)
+        cell_masks = tuple(tuple(mask for mask in masks if mask >> cell & 1)
+                           for cell in range(size * size))
+        _CELL_WIN_MASKS[(size, k)] = cell_masks
+    return cell_masks
+
+_COLUMN_MASKS = {}
+
+def get_column_masks(size):
+    """Bit masks of every cell but the first column, and of every cell but the last one."""
+    masks = _COLUMN_MASKS.get(size)
+    if masks is None:
+        cells = range(size * size)
+        masks = (sum(1 << cell for cell in cells if cell % size != 0),
+                 sum(1 << cell for cell in cells if cell % size != size - 1))
+        _COLUMN_MASKS[size] = masks
+    return masks
+
+_ZOBRIST_KEYS = {}
+
+def get_zobrist_keys(size):
+    """Random 64 bit keys for every (player, cell) pair and for the second player to move."""
+    keys = _ZOBRIST_KEYS.get(size)
+    if keys is None:
+        # Seeded by the size so every process hashes the same position the same way
+        rng = random.Random(size)
+        cell_keys = {Marker.X: [rng.getrandbits(64) for _ in range(size * size)],
+                     Marker.O: [rng.getrandbits(64) for _ in range(size * size)]}
+        keys = cell_keys, rng.getrandbits(64)
+        _ZOBRIST_KEYS[size] = keys
+    return keys
+
+_SYMMETRIES = {}
+
+def get_symmetries(size):
+    """
+    The 8 symmetries of a size x size board as cell permutations, their inverses
+    and per-byte lookup tables that transform a whole bitboard at once.
+    """
+    symmetries = _SYMMETRIES.get(size)
+    if symmetries is None:
+        n_cells = size * size
+        perms = []
+        for transform in range(8):
+            perm = []
+            for cell in range(n_cells):
+                row, col = divmod(cell, size)
+                if transform & 4:
+                    row, col = col, row
+                if transform & 1:
+                    row = size - row - 1
+                if transform & 2:
+                    col = size - col - 1
+                perm.append(row * size + col)
+            perms.append(perm)
+
+        inverses = []
+        for perm in perms:
+            inverse = [0] * n_cells
+            for cell, image in enumerate(perm):
+                inverse[image] = cell
+            inverses.append(inverse)
+
+        tables = []
+        for perm in perms:
+            chunks = []
+            for first in range(0, n_cells, 8):
+                cells = perm[first:first + 8]
+                chunk = [0] * 256
+                for byte in range(1, 256):
+                    low = (byte & -byte).bit_length() - 1
+                    chunk[byte] = chunk[byte & (byte - 1)]
+                    if low < len(cells):
+                        chunk[byte] |= 1 << cells[low]
+                chunks.append(chunk)
+            tables.append(chunks)
+
+        symmetries = perms, inverses, tables
+        _SYMMETRIES[size] = symmetries
+    return symmetries
+
 class TTTBoard:
-    def __init__(self, board=None, size=3):
+    def __init__(self, board=None, size=3, k=None, radius=None):
         self.cur_player = Marker.X
         self.next_player = Marker.O
         self.empty = Marker.EMPTY
@@ -24,23 +143,134 @@ class TTTBoard:
         self.second_player = Marker.O
         self.winner = None
 
-        self.position = {}
+        # One bitboard per player, bit (row * size + col) is set when the cell is taken
         self.size = size
-        self._create_board()
+        self.bitboards = {Marker.X: 0, Marker.O: 0}
+        # k stones in a row win, k=size is plain tic-tac-toe
+        self.k = size if k is None else k
+        self.win_masks = get_win_masks(size, self.k)
+        self.cell_win_masks = get_cell_win_masks(size, self.k)
+        self.full_mask = (1 << size * size) - 1
+
+        # With a radius, moves are only generated on empty cells at most radius
+        # cells (in any direction) away from a stone, see get_all_possible_actions()
+        self.radius = radius
+
+        # Zobrist hash of the position, updated incrementally by push/pop
+        self.cell_keys, self.side_key = get_zobrist_keys(size)
+        self.hash = 0
+
+        # Empty cells are kept in a list with a reverse index so push/pop are O(1),
+        # history holds what pop() needs to undo a push()
+        self.empty_cells = list(range(size * size))
+        self.empty_index = list(range(size * size))
+        self.history = []
 
         if board is not None:
-            self.__dict__ = deepcopy(board.__dict__)
-    
-    def _create_board(self):
-        for row in range(self.size):
-            for col in range(self.size):
-                self.position[row, col] = self.empty
+            self.__dict__ = board.copy().__dict__
+
+    def copy(self):
+        board = TTTBoard.__new__(TTTBoard)
+        board.__dict__.update(self.__dict__)
+        board.bitboards = dict(self.bitboards)
+        board.empty_cells = list(self.empty_cells)
+        board.empty_index = list(self.empty_index)
+        board.history = list(self.history)
+        return board
+
+    @property
+    def position(self):
+        return {(row, col): self.get_marker(row, col)
+                for row in range(self.size) for col in range(self.size)}
+
+    @position.setter
+    def position(self, position):
+        bitboards = {Marker.X: 0, Marker.O: 0}
+        for (row, col), marker in position.items():
+            if marker in bitboards:
+                bitboards[marker] |= 1 << (row * self.size + col)
+        self._set_bitboards(bitboards)
+
+    def encode(self):
+        # Compact, picklable form of the board: its rules, both bitboards and the side to move
+        return (self.size,
+                self.k,
+                self.radius,
+                self.bitboards[self.first_player],
+                self.bitboards[self.second_player],
+                self.cur_player == self.first_player)
+
+    @classmethod
+    def decode(cls, code):
+        size, k, radius, first_bits, second_bits, first_to_move = code
+        board = cls(size=size, k=k, radius=radius)
+        if not first_to_move:
+            board.cur_player, board.next_player = board.next_player, board.cur_player
+        board._set_bitboards({board.first_player: first_bits, board.second_player: second_bits})
+        return board
+
+    def __reduce__(self):
+        # Pickled as encode() so the shared win mask and Zobrist tables are not
+        # copied to other processes, decode() takes them from the local cache
+        return (type(self).decode, (self.encode(),))
+
+    def __copy__(self):
+        # copy() and not __reduce__(), which would drop the history pop() needs
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        # The win masks and Zobrist tables are shared caches, only the position
+        # and its history are the board's own
+        return self.copy()
+
+    def to_bytes(self):
+        # Fixed size form of the position for the board's size: both bitboards
+        # as little-endian bytes and the side to move, see from_bytes()
+        n_bytes = (self.size * self.size + 7) // 8
+        return (self.bitboards[self.first_player].to_bytes(n_bytes, 'little')
+                + self.bitboards[self.second_player].to_bytes(n_bytes, 'little')
+                + bytes([self.cur_player == self.first_player]))
+
+    @classmethod
+    def from_bytes(cls, data, size=3, k=None, radius=None):
+        n_bytes = (size * size + 7) // 8
+        return cls.decode((size, k, radius,
+                           int.from_bytes(data[:n_bytes], 'little'),
+                           int.from_bytes(data[n_bytes:2 * n_bytes], 'little'),
+                           bool(data[2 * n_bytes])))
+
+    def _set_bitboards(self, bitboards):
+        self.bitboards = bitboards
+        self.winner = self._find_winner()
+
+        occupied = self.bitboards[Marker.X] | self.bitboards[Marker.O]
+        self.empty_cells = [cell for cell in range(self.size * self.size) if not occupied >> cell & 1]
+        self.empty_index = [0] * (self.size * self.size)
+        for idx, cell in enumerate(self.empty_cells):
+            self.empty_index[cell] = idx
+        self.history = []
+        self.hash = self._compute_hash()
+
+    def get_marker(self, row, col):
+        bit = 1 << (row * self.size + col)
+        for marker, bits in self.bitboards.items():
+            if bits & bit:
+                return marker
+        return self.empty
+
+    def to_array(self):
+        # +1 for the first player, -1 for the second player and 0 for empty cells
+        array = np.zeros(self.size * self.size, dtype=np.int8)
+        for sign, marker in ((1, self.first_player), (-1, self.second_player)):
+            bits = self.bitboards[marker]
+            array[[cell for cell in range(self.size * self.size) if bits >> cell & 1]] = sign
+        return array
 
     def __str__(self):
         board_str = "==" * self.size + "\n"
         for row in range(self.size):
             for col in range(self.size):
-                board_str += " %s" % self.position[row, col]
+                board_str += " %s" % self.get_marker(row, col)
             board_str += '\n'
         board_str += "==" * self.size + "\n"
 
@@ -53,87 +283,144 @@ class TTTBoard:
         return board_str
 
     def move(self, row, col):
-        board = TTTBoard(self)
-        board.position[row, col] = self.cur_player
-        board.cur_player, board.next_player = board.next_player, board.cur_player
+        board = self.copy()
+        board.push(row, col)
         return board
 
+    def push(self, row, col):
+        cell = row * self.size + col
+        idx = self.empty_index[cell]
+        last = self.empty_cells.pop()
+        if last != cell:
+            self.empty_cells[idx] = last
+            self.empty_index[last] = idx
+
+        self.history.append((cell, idx, self.winner))
+        bits = self.bitboards[self.cur_player] | 1 << cell
+        self.bitboards[self.cur_player] = bits
+        self.hash ^= self.cell_keys[self.cur_player][cell] ^ self.side_key
+        # Only the lines through the new stone can have been completed
+        if self.winner is None:
+            for mask in self.cell_win_masks[cell]:
+                if bits & mask == mask:
+                    self.winner = self.cur_player
+                    break
+        self.cur_player, self.next_player = self.next_player, self.cur_player
+
+    def hash_after(self, row, col):
+        # Hash of the position after push(row, col), without making the move
+        return self.hash ^ self.cell_keys[self.cur_player][row * self.size + col] ^ self.side_key
+
+    def _compute_hash(self):
+        key = 0
+        for marker, bits in self.bitboards.items():
+            for cell in range(self.size * self.size):
+                if bits >> cell & 1:
+                    key ^= self.cell_keys[marker][cell]
+        if self.cur_player != self.first_player:
+            key ^= self.side_key
+        return key
+
+    def canonical(self):
+        """
+        Key shared by all 8 symmetric images of this position, and the transform
+        that maps this board onto the canonical image.
+        """
+        return self._canonical(self.bitboards[self.first_player],
+                               self.bitboards[self.second_player],
+                               self.cur_player == self.first_player)
+
+    def canonical_after(self, row, col):
+        # canonical() of the position after push(row, col), without making the move
+        bit = 1 << (row * self.size + col)
+        first_bits = self.bitboards[self.first_player]
+        second_bits = self.bitboards[self.second_player]
+        if self.cur_player == self.first_player:
+            return self._canonical(first_bits | bit, second_bits, False)
+        return self._canonical(first_bits, second_bits | bit, True)
+
+    def _canonical(self, first_bits, second_bits, first_to_move):
+        _, _, tables = get_symmetries(self.size)
+        n_cells = self.size * self.size
+        best_key, best_transform = None, 0
+        for transform, chunks in enumerate(tables):
+            key = 0
+            for shift, bits in ((0, first_bits), (n_cells, second_bits)):
+                k = 0
+                while bits:
+                    key |= chunks[k][bits & 255] << shift
+                    bits >>= 8
+                    k += 1
+            if best_key is None or key < best_key:
+                best_key, best_transform = key, transform
+        return best_key << 1 | first_to_move, best_transform
+
+    def transform_action(self, action, transform, inverse=False):
+        perms, inverses, _ = get_symmetries(self.size)
+        perm = inverses[transform] if inverse else perms[transform]
+        return divmod(perm[action[0] * self.size + action[1]], self.size)
+
+    def pop(self):
+        cell, idx, winner = self.history.pop()
+        self.cur_player, self.next_player = self.next_player, self.cur_player
+        self.bitboards[self.cur_player] &= ~(1 << cell)
+        self.hash ^= self.cell_keys[self.cur_player][cell] ^ self.side_key
+        self.winner = winner
+
+        if idx == len(self.empty_cells):
+            self.empty_cells.append(cell)
+        else:
+            moved = self.empty_cells[idx]
+            self.empty_index[moved] = len(self.empty_cells)
+            self.empty_cells.append(moved)
+            self.empty_cells[idx] = cell
+        self.empty_index[cell] = idx
+        return divmod(cell, self.size)
+
     def evaluate_game(self):
-        for row in range(self.size):
-            win_cnt = 0
-            lose_cnt = 0
-            for col in range(self.size):
-                if self.position[row, col] == self.first_player:
-                    win_cnt += 1
-                if self.position[row, col] == self.second_player:
-                    lose_cnt += 1
-                if win_cnt == self.size:
-                    self.winner = self.first_player
-                    return GAME_RESULT.WIN
-                if lose_cnt == self.size:
-                    self.winner = self.second_player
-                    return GAME_RESULT.LOSE
-
-        for col in range(self.size):
-            win_cnt = 0
-            lose_cnt = 0
-            for row in range(self.size):
-                if self.position[row, col] == self.first_player:
-                    win_cnt += 1
-                if self.position[row, col] == self.second_player:
-                    lose_cnt += 1
-                if win_cnt == self.size:
-                    self.winner = self.first_player
-                    return GAME_RESULT.WIN
-                if lose_cnt == self.size:
-                    self.winner = self.second_player
-                    return GAME_RESULT.LOSE
-        
-        win_cnt = 0
-        lose_cnt = 0
-        for row in range(self.size):
-            col = row
-            if self.position[row, col] == self.first_player:
-                win_cnt += 1
-            if self.position[row, col] == self.second_player:
-                lose_cnt += 1
-            if win_cnt == self.size:
-                self.winner = self.first_player
-                return GAME_RESULT.WIN
-            if lose_cnt == self.size:
-                self.winner = self.second_player
-                return GAME_RESULT.LOSE
-        
-        win_cnt = 0
-        lose_cnt = 0
-        for row in range(self.size):
-            col = self.size - row - 1
-            if self.position[row, col] == self.first_player:
-                win_cnt += 1
-            if self.position[row, col] == self.second_player:
-                lose_cnt += 1
-            if win_cnt == self.size:
-                self.winner = self.first_player
-                return GAME_RESULT.WIN
-            if lose_cnt == self.size:
-                self.winner = self.second_player
-                return GAME_RESULT.LOSE
+        # The winner is kept up to date by push/pop, see _find_winner() for a full scan
+        if self.winner == self.first_player:
+            return GAME_RESULT.WIN
+        if self.winner == self.second_player:
+            return GAME_RESULT.LOSE
+
+    def _find_winner(self):
+        for marker in (self.first_player, self.second_player):
+            bits = self.bitboards[marker]
+            for mask in self.win_masks:
+                if bits & mask == mask:
+                    return marker
     
     def is_finished(self):
-        for mark in self.position.values():
-            if mark == self.empty:
-                return False
-        return True
+        return not self.empty_cells
+
+    def get_all_possible_actions(self):
+        if self.radius is None:
+            return [divmod(cell, self.size) for cell in sorted(self.empty_cells)]
+
+        occupied = self.bitboards[Marker.X] | self.bitboards[Marker.O]
+        if not occupied:
+            return [(self.size // 2, self.size // 2)]
+        # Grow the stones by one cell in every direction radius times, the shifts
+        # by one column drop the bits that wrapped around into the next row
+        not_first_col, not_last_col = get_column_masks(self.size)
+        near = occupied
+        for _ in range(self.radius):
+            near |= (near << 1) & not_first_col | (near >> 1) & not_last_col
+            near |= near << self.size | near >> self.size
+        candidates = near & self.full_mask & ~occupied
+
+        actions = []
+        while candidates:
+            low = candidates & -candidates
+            actions.append(divmod(low.bit_length() - 1, self.size))
+            candidates ^= low
+        return actions
 
     def get_all_possible_states(self):
-        states = []
-        for row in range(self.size):
-            for col in range(self.size):
-                if self.position[row, col] == self.empty:
-                    states.append(self.move(row, col))
-        return states
+        return [self.move(row, col) for row, col in self.get_all_possible_actions()]
 
-    def play(self):
+    def play(self, book=None):
         print('\n Start Tic Tac Toe \n')
         print('  Type "q" to quit the game')
         # self.position = {
@@ -142,6 +429,8 @@ class TTTBoard:
         #     (2, 0): '.', (2, 1): '.', (2, 2): '.',
         # }
         print(self)
+        # One engine for the whole game, every played move re-roots its tree
+        mcts = None
         while True:
             try:
                 user_input = input('>> ')
@@ -151,12 +440,14 @@ class TTTBoard:
                 row = int(re.split(r',|,\s+| ', user_input)[0])
                 col = int(re.split(r',|, | ', user_input)[1])
 
-                if self.position[row, col] != self.empty:
+                if self.get_marker(row, col) != self.empty:
                     print('Already put!!')
                     continue
 
                 self = self.move(row, col)
                 print(self)
+                if mcts is not None:
+                    mcts.advance(self)
                 
                 result = self.evaluate_game()
                 if result == GAME_RESULT.WIN:
@@ -170,15 +461,18 @@ class TTTBoard:
                         print('Game is drawn!\n')
                         break
 
-                mcts = MCTS(
-                    state=self,
-                    budgets=1200,
-                    exploration_constant=1.414,
-                    max_depth=5,
-                    visible_graph=True)
+                if mcts is None:
+                    mcts = MCTS(
+                        state=self,
+                        budgets=1200,
+                        exploration_constant=1.414,
+                        max_depth=5,
+                        book=book,
+                        visible_graph=True)
 
                 action = mcts.search()
                 self = action
+                mcts.advance(self)
                 print(self)
                 
                 result = self.evaluate_game()
@@ -200,5 +494,7 @@ class TTTBoard:
 
 if __name__ == "__main__":
     board = TTTBoard()
+    # Replayed openings are answered from the book instead of searched again
+    book = OpeningBook()
     while True:
-        board.play()
\ No newline at end of file
+        board.play(book)
\ No newline at end of file
@@ -0,0 +1,379 @@
+import os
+import json
+import mmap
+import struct
+import threading
+import numpy as np
+
+from contextlib import nullcontext
+
+_NO_LOCK = nullcontext()
+
+# Saved trees start with MAGIC, the format version and the length of a JSON
+# header that gives the offset of every array in the file
+MAGIC = b'MCTSTREE'
+FORMAT_VERSION = 1
+_PREAMBLE = struct.Struct('<8sII')
+_ALIGNMENT = 64
+_PENDING = object()
+
+
+class LazyStates:
+    """
+    The states of a loaded tree. A state is decoded from its saved bytes the
+    first time it is read, None for the nodes that were saved without one.
+    """
+
+    def __init__(self, codes, has_state, decode):
+        self._codes = codes
+        self._has_state = has_state
+        self._decode = decode
+        self._states = [_PENDING] * len(codes)
+
+    def __len__(self):
+        return len(self._states)
+
+    def __getitem__(self, node):
+        state = self._states[node]
+        if state is _PENDING:
+            state = self._decode(self._codes[node].tobytes()) if self._has_state[node] else None
+            self._states[node] = state
+        return state
+
+    def __setitem__(self, node, state):
+        self._states[node] = state
+
+    def __iter__(self):
+        return (self[node] for node in range(len(self)))
+
+    def append(self, state):
+        self._states.append(state)
+
+    def encoded(self, node):
+        # Saved bytes of a state that was never decoded, None otherwise
+        if node < len(self._codes) and self._states[node] is _PENDING and self._has_state[node]:
+            return self._codes[node].tobytes()
+
+    def take(self, nodes):
+        # States of nodes, in that order, still undecoded where they were
+        codes = np.zeros((len(nodes),) + self._codes.shape[1:], dtype=np.uint8)
+        has_state = np.zeros(len(nodes), dtype=bool)
+        saved = nodes < len(self._codes)
+        codes[saved] = self._codes[nodes[saved]]
+        has_state[saved] = self._has_state[nodes[saved]]
+        states = LazyStates(codes, has_state, self._decode)
+        states._states = [self._states[node] for node in nodes.tolist()]
+        return states
+
+
+class SearchTree:
+    """
+    Struct-of-arrays search tree.
+
+    Every node is a row index into the per-node arrays below. The children
+    of a node are a contiguous block of the edge arrays starting at
+    first_child[node], so a node's child statistics can be gathered with
+    plain fancy indexing. The block has room for n_reserved[node] edges, the
+    actions of the n_children[node] first ones have a child and the rest are
+    still untried, see untried_action(). edge_prior holds the prior
+    probability of every edge's action, used by the PUCT policy.
+
+    Structural changes (adding nodes and edges) are serialized by lock. Once
+    enable_locking() is called, node statistics are guarded by a small set of
+    striped locks, see node_lock().
+    """
+
+    # name, dtype, initial value
+    NODE_FIELDS = (
+        ('visits', np.int64, 0),
+        ('reward', np.float64, 0),
+        ('reward_sq', np.float64, 0),
+        ('q', np.float64, -np.inf),
+        ('depth', np.int32, 0),
+        ('player', np.int8, 0),
+        ('parent', np.int64, -1),
+        ('first_child', np.int64, -1),
+        ('n_children', np.int32, 0),
+        ('n_reserved', np.int32, 0),
+        # Exact value of a node solved by the search, NaN until it is proven
+        ('proven', np.float32, np.nan),
+    )
+    EDGE_FIELDS = (
+        ('edges', np.int64, -1),
+        ('edge_action', np.int32, -1),
+        ('edge_prior', np.float32, 0),
+    )
+
+    def __init__(self, capacity=1024):
+        self.n_nodes = 0
+        self.n_edges = 0
+        self.states = []
+        self.markers = [None]
+        self._marker_codes = {None: 0}
+        self.lock = threading.RLock()
+        self.node_locks = None
+
+        for name, dtype, _ in self.NODE_FIELDS:
+            setattr(self, name, np.empty(0, dtype=dtype))
+        self.edges = np.empty(0, dtype=np.int64)
+        self.edge_action = np.empty((0, 2), dtype=np.int32)
+        self.edge_prior = np.empty(0, dtype=np.float32)
+        self._grow_nodes(capacity)
+        self._grow_edges(capacity)
+
+    def __len__(self):
+        return self.n_nodes
+
+    def enable_locking(self, n_stripes=64):
+        if self.node_locks is None:
+            self.node_locks = [threading.Lock() for _ in range(n_stripes)]
+
+    def node_lock(self, node):
+        if self.node_locks is None:
+            return _NO_LOCK
+        return self.node_locks[node % len(self.node_locks)]
+
+    def _grow_nodes(self, capacity):
+        # Hold every stripe so no statistics update lands in the old arrays
+        locks = self.node_locks or []
+        for lock in locks:
+            lock.acquire()
+        try:
+            self._resize(self.NODE_FIELDS, capacity)
+        finally:
+            for lock in locks:
+                lock.release()
+
+    def _grow_edges(self, capacity):
+        self._resize(self.EDGE_FIELDS, capacity)
+
+    def _resize(self, fields, capacity):
+        for name, dtype, init in fields:
+            old = getattr(self, name)
+            new = np.full((capacity,) + old.shape[1:], init, dtype=dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def player_code(self, marker):
+        code = self._marker_codes.get(marker)
+        if code is None:
+            code = len(self.markers)
+            self.markers.append(marker)
+            self._marker_codes[marker] = code
+        return code
+
+    def get_player(self, node):
+        return self.markers[self.player[node]]
+
+    def add_node(self, state, depth, player, parent=-1):
+        with self.lock:
+            node = self.n_nodes
+            if node == len(self.visits):
+                self._grow_nodes(max(2 * len(self.visits), 1024))
+
+            self.depth[node] = depth
+            self.player[node] = self.player_code(player)
+            self.parent[node] = parent
+            self.states.append(state)
+            self.n_nodes += 1
+        return node
+
+    def reserve_children(self, node, n, actions=None, priors=None):
+        # actions, when given, are stored as the node's untried actions in that
+        # order, along with their priors (uniform without them)
+        with self.lock:
+            first = self.n_edges
+            if first + n > len(self.edges):
+                self._grow_edges(max(2 * len(self.edges), first + n))
+            self.n_edges += n
+
+            self.n_children[node] = 0
+            self.n_reserved[node] = n
+            self.first_child[node] = first
+            if actions:
+                self.edge_action[first:first + n] = actions
+            if n:
+                self.edge_prior[first:first + n] = 1 / n if priors is None else priors
+
+    def n_untried(self, node):
+        return self.n_reserved[node] - self.n_children[node]
+
+    def untried_action(self, node):
+        # The next untried action, link() a child for it to take it off the list
+        return tuple(self.edge_action[self.first_child[node] + self.n_children[node]].tolist())
+
+    def link(self, node, child, action):
+        with self.lock:
+            # The edge is written before it is counted so readers never see a stale slot
+            edge = self.first_child[node] + self.n_children[node]
+            self.edges[edge] = child
+            self.edge_action[edge] = action
+            self.n_children[node] += 1
+
+    def add_child(self, node, state, action, player):
+        with self.lock:
+            child = self.add_node(state, self.depth[node] + 1, player, parent=node)
+            self.link(node, child, action)
+        return child
+
+    def children(self, node):
+        first = self.first_child[node]
+        return self.edges[first:first + self.n_children[node]]
+
+    def child_actions(self, node):
+        first = self.first_child[node]
+        actions = self.edge_action[first:first + self.n_children[node]]
+        return [tuple(action) for action in actions.tolist()]
+
+    def subtree(self, root):
+        """
+        Compact copy of everything reachable from root, with root as node 0 and
+        depths counted from it. Also returns an array that maps old node ids to
+        new ones, -1 for the nodes that were dropped.
+        """
+        mapping = np.full(self.n_nodes, -1, dtype=np.int64)
+        mapping[root] = 0
+        order = [root]
+        for node in order:
+            for child in self.children(node).tolist():
+                if mapping[child] < 0:
+                    mapping[child] = len(order)
+                    order.append(child)
+        order = np.array(order, dtype=np.int64)
+        n_nodes = len(order)
+
+        counts = self.n_reserved[order].astype(np.int64)
+        n_edges = int(counts.sum())
+        firsts = np.cumsum(counts) - counts
+        old_edges = np.repeat(self.first_child[order] - firsts, counts) + np.arange(n_edges)
+
+        tree = SearchTree(capacity=max(2 * n_nodes, 1024))
+        if n_edges > len(tree.edges):
+            tree._grow_edges(2 * n_edges)
+        for name, _, _ in self.NODE_FIELDS:
+            getattr(tree, name)[:n_nodes] = getattr(self, name)[order]
+        parents = self.parent[order]
+        tree.parent[:n_nodes] = np.where(parents >= 0, mapping[parents], -1)
+        tree.depth[:n_nodes] -= self.depth[root]
+        tree.first_child[:n_nodes] = np.where(self.first_child[order] >= 0, firsts, -1)
+        old_children = self.edges[old_edges]
+        tree.edges[:n_edges] = np.where(old_children >= 0, mapping[old_children], -1)
+        tree.edge_action[:n_edges] = self.edge_action[old_edges]
+        tree.edge_prior[:n_edges] = self.edge_prior[old_edges]
+
+        tree.n_nodes = n_nodes
+        tree.n_edges = n_edges
+        if isinstance(self.states, LazyStates):
+            tree.states = self.states.take(order)
+        else:
+            tree.states = [self.states[node] for node in order.tolist()]
+        tree.markers = list(self.markers)
+        tree._marker_codes = dict(self._marker_codes)
+        return tree, mapping
+
+    def save(self, path, encode, meta=None):
+        """
+        Write the tree to path as one binary file: a JSON header, then the used
+        part of every node and edge array, each 64-byte aligned, then the
+        states as rows of bytes. encode(state) must return the same number of
+        bytes for every state. meta is any JSON data kept in the header, e.g.
+        what decode needs to rebuild the states, see load(). The player markers
+        are kept there too, so they must be JSON values like 'X' and 'O'. Only
+        raw arrays and JSON are ever read back, nothing is unpickled.
+        """
+        codes = []
+        for node in range(self.n_nodes):
+            code = self.states.encoded(node) if isinstance(self.states, LazyStates) else None
+            if code is None and self.states[node] is not None:
+                code = encode(self.states[node])
+            codes.append(code)
+        width = max((len(code) for code in codes if code is not None), default=0)
+        state_codes = np.zeros((self.n_nodes, width), dtype=np.uint8)
+        has_state = np.zeros(self.n_nodes, dtype=bool)
+        for node, code in enumerate(codes):
+            if code is not None:
+                if len(code) != width:
+                    raise ValueError("encode() must return the same number of bytes for every state")
+                state_codes[node] = np.frombuffer(code, dtype=np.uint8)
+                has_state[node] = True
+
+        arrays = {name: getattr(self, name)[:self.n_nodes] for name, _, _ in self.NODE_FIELDS}
+        arrays.update({name: getattr(self, name)[:self.n_edges] for name, _, _ in self.EDGE_FIELDS})
+        arrays['state_codes'] = state_codes
+        arrays['has_state'] = has_state
+
+        layout, offset = {}, 0
+        for name, array in arrays.items():
+            layout[name] = {'offset': offset, 'dtype': array.dtype.str, 'shape': array.shape}
+            offset += -(-array.nbytes // _ALIGNMENT) * _ALIGNMENT
+        header = json.dumps({'n_nodes': self.n_nodes,
+                             'n_edges': self.n_edges,
+                             'markers': self.markers,
+                             'meta': meta,
+                             'arrays': layout}).encode()
+        start = -(-(_PREAMBLE.size + len(header)) // _ALIGNMENT) * _ALIGNMENT
+
+        # A tree loaded from path still maps that file, so the new one is
+        # written beside it and moved into place
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+            f.write(header)
+            for name, array in arrays.items():
+                f.seek(start + layout[name]['offset'])
+                f.write(np.ascontiguousarray(array).tobytes())
+            f.truncate(start + offset)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, decode):
+        """
+        Open a tree written by save(). The file is memory mapped copy-on-write,
+        so loading reads nothing but the header and the file is never written
+        to. The arrays are copied into memory the first time the tree grows,
+        and decode(data, meta) rebuilds a state the first time it is read.
+        """
+        with open(path, 'rb') as f:
+            magic, version, header_size = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+            if magic != MAGIC or version != FORMAT_VERSION:
+                raise ValueError(f"{path} is not a search tree of format version {FORMAT_VERSION}")
+            header = json.loads(f.read(header_size))
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        start = -(-(_PREAMBLE.size + header_size) // _ALIGNMENT) * _ALIGNMENT
+
+        arrays = {}
+        for name, layout in header['arrays'].items():
+            dtype = np.dtype(layout['dtype'])
+            shape = tuple(layout['shape'])
+            count = int(np.prod(shape))
+            arrays[name] = np.frombuffer(buffer, dtype=dtype, count=count,
+                                         offset=start + layout['offset']).reshape(shape)
+
+        tree = cls(capacity=0)
+        for name, _, _ in cls.NODE_FIELDS + cls.EDGE_FIELDS:
+            setattr(tree, name, arrays[name])
+        tree.n_nodes = header['n_nodes']
+        tree.n_edges = header['n_edges']
+        tree.markers = header['markers']
+        tree._marker_codes = {marker: code for code, marker in enumerate(tree.markers)}
+        meta = header['meta']
+        tree.states = LazyStates(arrays['state_codes'], arrays['has_state'], lambda data: decode(data, meta))
+        return tree
+
+    def to_networkx(self):
+        import networkx as nx
+
+        graph = nx.DiGraph()
+        for node in range(self.n_nodes):
+            graph.add_node(node,
+                           node=node,
+                           depth=int(self.depth[node]),
+                           state=self.states[node],
+                           visits=int(self.visits[node]),
+                           reward=float(self.reward[node]),
+                           q=float(self.q[node]),
+                           player=self.get_player(node))
+        for node in range(self.n_nodes):
+            for child, action in zip(self.children(node), self.child_actions(node)):
+                graph.add_edge(node, int(child), action=action)
+        return graph